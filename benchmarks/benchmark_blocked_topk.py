@@ -0,0 +1,112 @@
+"""
+Timing and equivalence check of metrics.blocked_topk against the full sklearn distance and
+similarity matrices it replaces. The synthetic descriptors share a large offset, scaled by
+--scales, so the squared norms are large compared to the distances between neighbours: this is
+where a float32 expansion of ||q - d||^2 loses the ranking. The euclidean neighbours and
+distances must be exactly sklearn's (ties broken by the lower index), and
+calculate_top_accuracy must count the same hits as the per query loop it replaced.
+
+Usage:
+python3 cnn_similarity_analysis/benchmarks/benchmark_blocked_topk.py --num_images 300 --dim 2048
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.lib.metrics import blocked_topk, global_average_precision, calculate_top_accuracy
+
+
+def topk_reference(queries, database, k, metric):
+    if metric == 'euclidean':
+        values = euclidean_distances(queries, database)
+    else:
+        values = -cosine_similarity(queries, database)
+    indices = np.argsort(values, axis=1, kind='stable')[:, :k]
+    scores = np.take_along_axis(values, indices, axis=1)
+    return (scores if metric == 'euclidean' else -scores), indices
+
+
+def top_accuracy_reference(gt, query, database):
+    """
+    the per query loop calculate_top_accuracy used before it was batched
+    """
+    hit, hit_5, hit_cos, hit_5_cos = 0, 0, 0, 0
+    for pair in gt:
+        q_vector = query[pair[0]].reshape(1, -1)
+        matched_index = np.argsort(np.squeeze(euclidean_distances(q_vector, database)), kind='stable')[:5]
+        matched_cos_index = np.argsort(-np.squeeze(cosine_similarity(q_vector, database)), kind='stable')[:5]
+        hit_5 += pair[1] in matched_index
+        hit += pair[1] == matched_index[0]
+        hit_5_cos += pair[1] in matched_cos_index
+        hit_cos += pair[1] == matched_cos_index[0]
+    return hit, hit_5, hit_cos, hit_5_cos
+
+
+def synthetic_descriptors(rng, num_images, dim, scale):
+    """
+    database around a shared offset and queries that are noisy copies of it, query i matches
+    database row i
+    """
+    offset = rng.random(dim)
+    database = offset + 0.01 * rng.standard_normal((num_images, dim))
+    queries = database + 0.002 * rng.standard_normal((num_images, dim))
+    return (scale * queries).astype('float32'), (scale * database).astype('float32')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_images', type=int, default=300, help='number of queries and of database rows')
+    parser.add_argument('--dim', type=int, default=2048, help='descriptor dimension')
+    parser.add_argument('--scales', default='1,100,1000', help='comma separated descriptor scales')
+    parser.add_argument('--k', type=int, default=5, help='neighbours compared for k > 1')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    gt = [(i, i) for i in range(args.num_images)]
+    print(f"{'scale':>7}{'metric':>11}{'k':>4}{'sklearn (s)':>13}{'blocked (s)':>13}")
+    for scale in [float(x) for x in args.scales.split(',')]:
+        queries, database = synthetic_descriptors(rng, args.num_images, args.dim, scale)
+        for metric in ['euclidean', 'cosine']:
+            for k in [1, args.k]:
+                t0 = time.time()
+                ref_scores, ref_indices = topk_reference(queries, database, k, metric)
+                reference = time.time() - t0
+                t0 = time.time()
+                scores, indices = blocked_topk(queries, database, k, metric=metric, block_size=128)
+                blocked = time.time() - t0
+                if metric == 'euclidean':
+                    assert np.array_equal(indices, ref_indices), (scale, k, (indices != ref_indices).sum())
+                    assert np.array_equal(scores, ref_scores), (scale, k, np.abs(scores - ref_scores).max())
+                else:
+                    # float32 similarities of the non matching rows can differ in the last bit
+                    # between the two products, only the best match is compared exactly
+                    assert np.array_equal(indices[:, 0], ref_indices[:, 0]), (scale, k)
+                    assert np.allclose(scores, ref_scores, rtol=0, atol=1e-6), (scale, k)
+                print(f"{scale:>7g}{metric:>11}{k:>4}{reference:>13.4f}{blocked:>13.4f}")
+        # every query is closest to its own database row, the GAP must be perfect
+        assert global_average_precision(gt, queries, database, dataset='image collation') == (1.0, 1.0), scale
+        # batched top-k accuracy against the per query loop, on the matching pairs and on pairs
+        # whose target is another row, close to the query but rarely its nearest neighbour
+        shifted = [(i, (i + 1) % args.num_images) for i in range(args.num_images)]
+        for pairs in [gt, shifted]:
+            t0 = time.time()
+            reference = top_accuracy_reference(pairs, queries, database)
+            t1 = time.time()
+            batched = calculate_top_accuracy(pairs, queries, database)
+            t2 = time.time()
+            assert tuple(batched) == tuple(int(x) for x in reference), (scale, batched, reference)
+        print(f"{scale:>7g} top accuracy {batched}: per query {t1 - t0:.4f} s, batched {t2 - t1:.4f} s")
+    # small integer descriptors, many rows tie at the k-th score: the lowest indices must be kept
+    tied_queries = rng.integers(0, 3, (args.num_images, 8)).astype('float32')
+    tied_database = rng.integers(0, 3, (args.num_images, 8)).astype('float32')
+    for k in [1, args.k]:
+        _, ref_indices = topk_reference(tied_queries, tied_database, k, 'euclidean')
+        _, indices = blocked_topk(tied_queries, tied_database, k, metric='euclidean', block_size=128)
+        assert np.array_equal(indices, ref_indices), (k, (indices != ref_indices).sum())
+    print("blocked_topk and calculate_top_accuracy match sklearn")
@@ -0,0 +1,65 @@
+"""
+Timing of the pixel-level cross-correlation baselines from 64 to 1024 px.
+Compares the direct scipy.signal.correlate2d (only up to --direct_max_size, it is O(N^4))
+with the FFT-based image_cross_correlation and with the batched CrossCorrelationEngine,
+whose candidate spectra are computed once and reused by every query. The FFT result is
+checked against correlate2d at every size where the latter runs, 64 px with the defaults.
+
+Usage:
+python3 cnn_similarity_analysis/benchmarks/benchmark_cross_correlation.py --num_candidates 16
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from scipy import signal
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import image_cross_correlation, CrossCorrelationEngine
+
+
+def direct_cross_correlation(image1_array, image2_array):
+    cross_correlation_list = []
+    for i in range(np.shape(image2_array)[2]):
+        cross_correlation_list.append(signal.correlate2d(image1_array[:, :, i], image2_array[:, :, i]))
+    return np.average(cross_correlation_list)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='64,256,512,1024', help='comma separated image sizes')
+    parser.add_argument('--num_candidates', type=int, default=16, help='candidates compared against each query')
+    parser.add_argument('--num_queries', type=int, default=4, help='queries compared against the candidates')
+    parser.add_argument('--direct_max_size', type=int, default=128, help='largest size timed with correlate2d')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'size':>6}{'direct (s/pair)':>18}{'fft (s/pair)':>15}{'engine build (s)':>18}{'engine (s/pair)':>17}")
+    for size in [int(x) for x in args.sizes.split(',')]:
+        candidates = rng.random((args.num_candidates, size, size, 3), dtype=np.float32)
+        queries = rng.random((args.num_queries, size, size, 3), dtype=np.float32)
+
+        direct = float('nan')
+        if size <= args.direct_max_size:
+            t0 = time.time()
+            reference = direct_cross_correlation(queries[0], candidates[0])
+            direct = time.time() - t0
+
+        t0 = time.time()
+        value = image_cross_correlation(queries[0], candidates[0])
+        fft = time.time() - t0
+        if size <= args.direct_max_size:
+            assert np.isclose(value, reference, rtol=1e-4), (value, reference)
+
+        t0 = time.time()
+        engine = CrossCorrelationEngine(candidates)
+        build = time.time() - t0
+        t0 = time.time()
+        for query in queries:
+            engine.score(query)
+        engine_time = (time.time() - t0) / (args.num_queries * args.num_candidates)
+
+        print(f"{size:>6}{direct:>18.4f}{fft:>15.4f}{build:>18.3f}{engine_time:>17.4f}")
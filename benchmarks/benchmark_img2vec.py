@@ -0,0 +1,69 @@
+"""
+Per-image latency of Img2Vec before and after truncating the network at the extraction layer.
+"Full" runs the whole model and reads the extraction layer through a forward hook,
+"truncated" runs Img2Vec.truncated_model, which stops at the extraction layer.
+
+Usage:
+python3 cnn_similarity_analysis/benchmarks/benchmark_img2vec.py --batch_size 16 --repeats 5
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from img2vec import Img2Vec
+
+MODEL_NAMES = ['alexnet', 'vgg-16', 'inception-v3', 'googlenet', 'densenet121', 'densenet169',
+               'resnet-18', 'resnet-34', 'resnet-50', 'resnet-101', 'resnet-152']
+
+
+def run_full(img2vec, images):
+    outputs = []
+
+    def copy_data(m, i, o):
+        outputs.append(o.data)
+
+    h = img2vec.extraction_layer.register_forward_hook(copy_data)
+    with torch.no_grad():
+        img2vec.model(images)
+    h.remove()
+    return outputs[0]
+
+
+def run_truncated(img2vec, images):
+    return img2vec._extract(images)
+
+
+def time_per_image(function, img2vec, images, repeats):
+    function(img2vec, images)  # warm-up
+    if img2vec.device.type == 'cuda':
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for _ in range(repeats):
+        function(img2vec, images)
+    if img2vec.device.type == 'cuda':
+        torch.cuda.synchronize()
+    t1 = time.time()
+    return (t1 - t0) / (repeats * images.shape[0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16, help='images per forward pass')
+    parser.add_argument('--repeats', type=int, default=5, help='timed forward passes per model')
+    parser.add_argument('--cuda', default=False, action='store_true', help='run on GPU')
+    parser.add_argument('--models', default=','.join(MODEL_NAMES), help='comma separated model names')
+    args = parser.parse_args()
+
+    print(f"{'model':<14}{'full (ms)':>12}{'truncated (ms)':>16}{'speedup':>10}  same output")
+    for model_name in args.models.split(','):
+        img2vec = Img2Vec(cuda=args.cuda, model=model_name)
+        images = torch.randn(args.batch_size, 3, 224, 224).to(img2vec.device)
+        full = time_per_image(run_full, img2vec, images, args.repeats)
+        truncated = time_per_image(run_truncated, img2vec, images, args.repeats)
+        same = torch.allclose(run_full(img2vec, images), run_truncated(img2vec, images), atol=1e-5)
+        print(f"{model_name:<14}{full * 1000:>12.2f}{truncated * 1000:>16.2f}{full / truncated:>10.2f}  {same}")
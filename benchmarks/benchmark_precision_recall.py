@@ -0,0 +1,63 @@
+"""
+Timing and equivalence check of metrics.precision_recall against the previous implementation,
+which ordered the predictions with a pure Python sort of (score, not label) tuples.
+The synthetic scores are rounded so that many predictions tie, which exercises the
+worst-case tie-breaking.
+
+Usage:
+python3 cnn_similarity_analysis/benchmarks/benchmark_precision_recall.py --num_predictions 10000000
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.lib.metrics import precision_recall, argsort
+
+
+def precision_recall_reference(y_true, probas_pred, num_positives):
+    probas_pred = probas_pred.flatten()
+    y_true = y_true.flatten()
+    order = argsort(list(zip(probas_pred, ~y_true)))
+    order = order[::-1]
+    probas_pred = probas_pred[order]
+    y_true = y_true[order]
+
+    ntp = np.cumsum(y_true)
+    nres = np.arange(len(y_true)) + 1
+
+    precisions = ntp / nres
+    recalls = ntp / num_positives
+    return precisions, recalls, probas_pred
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_predictions', type=int, default=10000000, help='number of synthetic predictions')
+    parser.add_argument('--decimals', type=int, default=3, help='scores are rounded to this many decimals')
+    parser.add_argument('--skip_reference', default=False, action='store_true',
+                        help='only time the lexsort version')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    probas_pred = np.round(rng.random(args.num_predictions), args.decimals)
+    y_true = rng.random(args.num_predictions) < 0.1
+    num_positives = int(y_true.sum()) + 1000
+
+    t0 = time.time()
+    p, r, t = precision_recall(y_true, probas_pred, num_positives)
+    t1 = time.time()
+    print(f"lexsort precision_recall: {t1 - t0:.2f} s for {args.num_predictions} predictions")
+
+    if not args.skip_reference:
+        t0 = time.time()
+        p_ref, r_ref, t_ref = precision_recall_reference(y_true, probas_pred, num_positives)
+        t1 = time.time()
+        print(f"python argsort reference: {t1 - t0:.2f} s")
+        assert np.array_equal(p, p_ref) and np.array_equal(r, r_ref) and np.array_equal(t, t_ref), \
+            "precision_recall differs from the reference"
+        print("outputs are identical")
@@ -1,10 +1,18 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.models as models
 import torchvision.transforms as transforms
 import numpy as np
+import os
+import itertools
+import threading
 import pdb
 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
 
 class Img2Vec():
 
@@ -25,6 +33,9 @@ class Img2Vec():
 
         self.model.eval()
 
+        # sub-network ending at the extraction layer, so no layer after it is computed
+        self.truncated_model = self._get_truncated_model(self.model, [self.extraction_layer])
+
         self.scaler = transforms.Scale((224, 224))
         self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                               std=[0.229, 0.224, 0.225])
@@ -39,53 +50,229 @@ class Img2Vec():
         if type(img) == list:
             a = [self.normalize(self.to_tensor(self.scaler(im))) for im in img]
             images = torch.stack(a).to(self.device)
-            if self.model_name == 'alexnet':
+            if self._has_flat_output():
                 my_embedding = torch.zeros(len(img), self.layer_output_size)
             else:
                 my_embedding = torch.zeros(len(img), self.layer_output_size, 1, 1)
 
-            def copy_data(m, i, o):
-                my_embedding.copy_(o.data)
-
-            h = self.extraction_layer.register_forward_hook(copy_data)
-            h_x = self.model(images)
-            h.remove()
+            my_embedding.copy_(self._extract(images))
 
             if tensor:
                 return my_embedding
             else:
-                if self.model_name == 'alexnet':
+                if self._has_flat_output():
                     return my_embedding.numpy()[:, :]
                 else:
-                    print(my_embedding.numpy()[:, :, 0, 0].shape)
                     return my_embedding.numpy()[:, :, 0, 0]
         else:
             image = self.normalize(self.to_tensor(self.scaler(img))).unsqueeze(0).to(self.device)
 
-            if self.model_name == 'alexnet' or self.model_name == 'vgg-16' \
-                    or self.model_name == 'inception-v3' or self.model_name == 'googlenet' \
-                    or 'densenet' in self.model_name:
+            if self._has_flat_output():
                 my_embedding = torch.zeros(1, self.layer_output_size)
             else:
                 my_embedding = torch.zeros(1, self.layer_output_size, 1, 1)
 
-            def copy_data(m, i, o):
-                my_embedding.copy_(o.data)
-
-            h = self.extraction_layer.register_forward_hook(copy_data)
-            h_x = self.model(image)
-            h.remove()
+            my_embedding.copy_(self._extract(image))
 
             if tensor:
                 return my_embedding
             else:
-                if self.model_name == 'alexnet' or self.model_name == 'vgg-16'\
-                        or self.model_name == 'inception-v3' or self.model_name == 'googlenet'\
-                        or 'densenet' in self.model_name:
+                if self._has_flat_output():
                     return my_embedding.numpy()[0, :]
                 else:
                     return my_embedding.numpy()[0, :, 0, 0]
 
+    def get_layer_vecs(self, img, layers, pooling=None, tensor=False):
+        """ Get embeddings of several layers from a single forward pass
+        :param img: PIL Image or list of PIL Images
+        :param layers: list of layers, each a String or Int as for the layer argument of Img2Vec
+        :param pooling: None, 'gem', 'max' or 'avg'. Pooling applied to spatial layer outputs
+        :param tensor: If True, the embeddings are FloatTensors instead of Numpy arrays
+        :returns: dict mapping each requested layer to its embedding. Outputs of shape (N, C, 1, 1)
+                  and pooled outputs are returned as (N, C), other spatial outputs as (N, C, H, W).
+                  The batch dimension is dropped when img is a single image
+        """
+        if type(img) == list:
+            images = torch.stack([self.normalize(self.to_tensor(self.scaler(im))) for im in img])
+        else:
+            images = self.normalize(self.to_tensor(self.scaler(img))).unsqueeze(0)
+        images = images.to(self.device)
+
+        modules = [self._get_layer(layer) for layer in layers]
+        model = self._get_truncated_model(self.model, modules)
+        if model is None:
+            model = self.model
+
+        outputs = {}
+        hooks = []
+        for layer, module in zip(layers, modules):
+            def copy_data(m, i, o, layer=layer):
+                # later in-place activations must not modify the stored output
+                outputs[layer] = o.data.clone()
+            hooks.append(module.register_forward_hook(copy_data))
+        with torch.no_grad():
+            model(images)
+        for h in hooks:
+            h.remove()
+
+        embeddings = {}
+        for layer in layers:
+            embedding = self._pool(outputs[layer], pooling).cpu()
+            if type(img) != list:
+                embedding = embedding[0]
+            embeddings[layer] = embedding if tensor else embedding.numpy()
+        return embeddings
+
+    def iter_vecs(self, images, batch_size=32, num_workers=4, prefetch=2):
+        """ Stream embeddings of an iterable of images in fixed-size batches
+        Worker threads decode and preprocess the next batches while the model runs on the current one,
+        so only prefetch + 1 batches are held in memory at any time.
+        :param images: iterable of image paths or PIL Images, possibly unbounded
+        :param batch_size: Int number of images per forward pass
+        :param num_workers: Int number of decoding threads
+        :param prefetch: Int number of batches decoded ahead of the model
+        :returns: generator of (index of the first image in the batch, Numpy ndarray of shape (n, dim))
+        """
+        def load(im):
+            if isinstance(im, str):
+                im = Image.open(im).convert('RGB')
+            return self.normalize(self.to_tensor(self.scaler(im)))
+
+        images = iter(images)
+        start = 0
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            pending = deque()
+            while True:
+                while len(pending) <= prefetch:
+                    chunk = list(itertools.islice(images, batch_size))
+                    if len(chunk) == 0:
+                        break
+                    pending.append([pool.submit(load, im) for im in chunk])
+                if len(pending) == 0:
+                    break
+                batch = torch.stack([f.result() for f in pending.popleft()]).to(self.device)
+                vectors = self._extract(batch).reshape(batch.shape[0], -1).cpu().numpy()
+                yield start, vectors
+                start += batch.shape[0]
+
+    def embed(self, images, out, batch_size=32, num_workers=4):
+        """ Embed an iterable of images into a preallocated output array
+        :param images: iterable of image paths or PIL Images
+        :param out: Numpy ndarray or memmap of shape (num_images, dim), see create_output
+        :param batch_size: Int number of images per forward pass
+        :param num_workers: Int number of decoding threads
+        :returns: Int number of embedded images
+        """
+        num_images = 0
+        for start, vectors in self.iter_vecs(images, batch_size=batch_size, num_workers=num_workers):
+            out[start:start + len(vectors)] = vectors
+            num_images = start + len(vectors)
+        if isinstance(out, np.memmap):
+            out.flush()
+        return num_images
+
+    def create_output(self, num_images, path=None):
+        """ Allocate the output array of embed
+        :param num_images: Int number of images to embed
+        :param path: If given, the array is a memory-mapped .npy file so it can be larger than RAM
+        :returns: float32 Numpy ndarray or memmap of shape (num_images, layer_output_size)
+        """
+        shape = (num_images, self.layer_output_size)
+        if path is None:
+            return np.empty(shape, dtype=np.float32)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+
+    def _extract(self, images):
+        """ Internal method running the network up to the extraction layer
+        :param images: normalized image batch on self.device
+        :returns: FloatTensor with the output of the extraction layer
+        """
+        with torch.no_grad():
+            if self.truncated_model is not None:
+                return self.truncated_model(images).data
+
+            # the forward pass of this model is not a plain sequence of modules:
+            # run it entirely and read the extraction layer through a hook
+            outputs = []
+
+            def copy_data(m, i, o):
+                outputs.append(o.data)
+
+            h = self.extraction_layer.register_forward_hook(copy_data)
+            self.model(images)
+            h.remove()
+            return outputs[0]
+
+    def _get_layer(self, layer):
+        """ Internal method resolving a layer name of the loaded model
+        :param layer: 'default', a module name such as 'layer3' or an Int indexing the classifier from the end
+        :returns: selected layer
+        """
+        if layer == 'default':
+            return self.extraction_layer
+        if type(layer) == int:
+            return self.model.classifier[-layer]
+        module = self.model._modules.get(layer)
+        if module is None:
+            raise KeyError('Layer %s was not found in model %s' % (layer, self.model_name))
+        return module
+
+    def _pool(self, x, pooling, p=3, eps=1e-6):
+        """ Internal method pooling a spatial layer output
+        :param x: FloatTensor of shape (N, C, H, W) or (N, C)
+        :param pooling: None, 'gem', 'max' or 'avg'
+        :returns: (N, C) FloatTensor, or the unpooled (N, C, H, W) map when pooling is None
+        """
+        if x.dim() != 4:
+            return x
+        if pooling is None:
+            if x.shape[2] * x.shape[3] == 1:
+                return x[:, :, 0, 0]
+            return x
+        if pooling == 'gem':
+            x = F.adaptive_avg_pool2d(torch.clamp(x, min=eps) ** p, (1, 1)) ** (1. / p)
+        elif pooling == 'max':
+            x = F.adaptive_max_pool2d(x, (1, 1))
+        elif pooling == 'avg':
+            x = F.adaptive_avg_pool2d(x, (1, 1))
+        else:
+            raise KeyError('Pooling %s was not found' % pooling)
+        return x[:, :, 0, 0]
+
+    def _get_truncated_model(self, model, layers):
+        """ Internal method building a sub-network that ends at the deepest of the given layers
+        :param model: pytorch model
+        :param layers: list of selected layers of the model
+        :returns: pytorch module running up to the layers, or None if the model cannot be truncated
+        """
+        if any(layer is list(model.children())[-1] for layer in layers):
+            # nothing is computed after the last layer
+            return model
+
+        if 'resnet' in self.model_name:
+            # fc is preceded by a flatten, every other child is applied in order
+            stages = list(model.children())[:-1]
+        elif self.model_name == 'alexnet' or self.model_name == 'vgg-16':
+            stages = [model.features, model.avgpool, nn.Flatten()] + list(model.classifier)
+        else:
+            return None
+
+        last = -1
+        for layer in layers:
+            indices = [i for i, stage in enumerate(stages) if stage is layer]
+            if len(indices) == 0:
+                return None
+            last = max(last, indices[0])
+        return nn.Sequential(*stages[:last + 1])
+
+    def _has_flat_output(self):
+        """ Internal method telling whether the extraction layer outputs (N, C) instead of (N, C, 1, 1)
+        :returns: Bool
+        """
+        return self.model_name == 'alexnet' or self.model_name == 'vgg-16' \
+            or self.model_name == 'inception-v3' or self.model_name == 'googlenet' \
+            or 'densenet' in self.model_name
+
     def _get_model_and_layer(self, model_name, layer):
         """ Internal method for getting layer from model
         :param model_name: model name such as 'resnet-18'
@@ -174,4 +361,88 @@ class Img2Vec():
             return model, layer
 
         else:
-            raise KeyError('Model %s was not found' % model_name)
\ No newline at end of file
+            raise KeyError('Model %s was not found' % model_name)
+
+
+def model_memory_bytes(model):
+    """ Estimate the memory held by a model's parameters and buffers
+    :param model: torch.nn.Module
+    :returns: Int number of bytes
+    """
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelRegistry():
+
+    def __init__(self, max_memory_mb=2048):
+        """ Process-wide cache of loaded Img2Vec instances
+        Instances are keyed by (model name, layer, device) and evicted in least-recently-used
+        order once the summed parameter memory exceeds the budget. The most recently used
+        instance is always kept, even if it alone is larger than the budget.
+        :param max_memory_mb: Int memory budget in megabytes, None for no limit
+        """
+        self.max_memory_mb = max_memory_mb
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, model='resnet-18', layer='default', cuda=False):
+        """ Get a cached Img2Vec, loading it on a cache miss
+        :param model: String name of requested model
+        :param layer: String or Int depending on model
+        :param cuda: If set to True, the instance runs on GPU
+        :returns: Img2Vec
+        """
+        key = (model, layer, "cuda" if cuda else "cpu")
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            img2vec = Img2Vec(cuda=cuda, model=model, layer=layer)
+            self._entries[key] = img2vec
+            self._sizes[key] = model_memory_bytes(img2vec.model)
+            self._evict()
+            return img2vec
+
+    def memory_bytes(self):
+        """ Total parameter memory held by the cached instances """
+        return sum(self._sizes.values())
+
+    def set_max_memory(self, max_memory_mb):
+        """ Change the memory budget, evicting instances if necessary """
+        with self._lock:
+            self.max_memory_mb = max_memory_mb
+            self._evict()
+
+    def clear(self):
+        """ Drop every cached instance """
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+
+    def _evict(self):
+        if self.max_memory_mb is None:
+            return
+        max_bytes = self.max_memory_mb * 1024 * 1024
+        while len(self._entries) > 1 and self.memory_bytes() > max_bytes:
+            key, _ = self._entries.popitem(last=False)
+            del self._sizes[key]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+MODEL_REGISTRY = ModelRegistry(max_memory_mb=int(os.environ.get('IMG2VEC_CACHE_MB', 2048)))
+
+
+def get_img2vec(model='resnet-18', layer='default', cuda=False):
+    """ Get a shared Img2Vec from the process-wide registry
+    The budget defaults to 2048 MB and can be set through the IMG2VEC_CACHE_MB
+    environment variable or MODEL_REGISTRY.set_max_memory.
+    """
+    return MODEL_REGISTRY.get(model=model, layer=layer, cuda=cuda)
@@ -1,16 +1,67 @@
 import numpy as np
+import pandas as pd
 import argparse, pdb
 import matplotlib.pyplot as plt
 
 from PIL import Image
-from utils import get_model_distance
+from utils import get_model_distance, load_image, get_batch_model_vectors, find_pair_distances, \
+    find_pair_pixel_distances
+
+MODEL_NAMES = ['alexnet', 'vgg-16', 'inception-v3', 'googlenet', 'densenet121', 'densenet169',
+               'resnet-18', 'resnet-34', 'resnet-50', 'resnet-101', 'resnet-152']
 
 parser = argparse.ArgumentParser(description='Similarity finder and analyzer')
-parser.add_argument('--img1', type=str, required=True, help='path to input image 1')
-parser.add_argument('--img2', type=str, required=True, help='path to input image 2')
+parser.add_argument('--img1', type=str, default=None, help='path to input image 1')
+parser.add_argument('--img2', type=str, default=None, help='path to input image 2')
 parser.add_argument('--size', type=int, default=256, help='image size for similarity comparison')
+parser.add_argument('--pairs', type=str, default=None,
+                    help='csv file with img1,img2 columns, compares every pair without display')
+parser.add_argument('--output', type=str, default='distances.csv',
+                    help='.csv or .parquet file receiving the distances of --pairs')
+parser.add_argument('--models', type=str, default=','.join(MODEL_NAMES),
+                    help='comma separated backbones used with --pairs')
+parser.add_argument('--batch_size', type=int, default=32, help='images per forward pass with --pairs')
+parser.add_argument('--cuda', default=False, action='store_true', help='run the backbones on GPU')
 args = parser.parse_args()
 
+
+def compare_pairs(args):
+    """
+    Headless batch mode: every distinct image is decoded once, each backbone embeds all of
+    them in batches and the distances of every pair are written to args.output
+    """
+    pairs = pd.read_csv(args.pairs)
+    paths = pd.unique(pd.concat([pairs['img1'], pairs['img2']]))
+    path_to_index = {path: i for i, path in enumerate(paths)}
+    index1 = pairs['img1'].map(path_to_index).values
+    index2 = pairs['img2'].map(path_to_index).values
+
+    images = np.empty((len(paths), args.size, args.size, 3), dtype=np.uint8)
+    for i, path in enumerate(paths):
+        images[i] = np.array(load_image(path, args.size))
+    print("decoded {} distinct images for {} pairs".format(len(paths), len(pairs)))
+
+    results = pd.DataFrame({'img1': pairs['img1'], 'img2': pairs['img2']})
+    results['pixel_distance'] = find_pair_pixel_distances(images, index1, index2)
+    for model_name in args.models.split(','):
+        vectors = get_batch_model_vectors(images, model_name, batch_size=args.batch_size, cuda=args.cuda)
+        results[model_name + '_distance'] = find_pair_distances(vectors[index1], vectors[index2])
+        print("{} distances computed".format(model_name))
+
+    if args.output.endswith('.parquet'):
+        results.to_parquet(args.output, index=False)
+    else:
+        results.to_csv(args.output, index=False)
+    print("writing distances to {}".format(args.output))
+
+
+if args.pairs is not None:
+    compare_pairs(args)
+    raise SystemExit
+
+if args.img1 is None or args.img2 is None:
+    parser.error('--img1 and --img2 are required when --pairs is not given')
+
 ## Loading Image and pre-processing
 image1 = Image.open(args.img1).convert('RGB')
 image2 = Image.open(args.img2).convert('RGB')
@@ -59,4 +110,3 @@ plt.imshow(image2)
 plt.title('Image 2')
 plt.axis('off')
 plt.show()
-
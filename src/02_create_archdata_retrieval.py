@@ -8,7 +8,6 @@ filepath: cnn_similarity_analysis/src
 
 import os
 import pdb
-import pickle
 from tqdm import tqdm
 import argparse
 
@@ -23,6 +22,7 @@ from lib.logger import Logger, log_function, print_
 from lib.model_setup import load_model
 from lib.utils import create_directory, for_all_methods, load_experiment_parameters
 from lib.arguments import process_experiment_directory_argument, process_checkpoint
+from lib.io import write_npy_descriptors
 from data.dataloader import get_classification_dataset
 
 
@@ -35,6 +35,11 @@ def process_arguments():
     # defining command line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--exp_directory", help="Path to the experiment directory")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Number of images embedded together. Above 1 the images are resized to the "
+                             "experiment image_size")
+    parser.add_argument("--num_workers", type=int, default=None,
+                        help="Number of loading processes, CONFIG num_workers by default")
     args = parser.parse_args()
 
     exp_directory = args.exp_directory
@@ -42,7 +47,9 @@ def process_arguments():
     # making sure experiment directory and checkpoint file exist
     exp_directory = process_experiment_directory_argument(exp_directory)
 
-    return exp_directory
+    params = {"batch_size": args.batch_size, "num_workers": args.num_workers}
+
+    return exp_directory, params
 
 @for_all_methods(log_function)
 class ArchDataExtractor:
@@ -53,6 +60,8 @@ class ArchDataExtractor:
     -----
     exp_path: string
         path to the experiment directory
+    params: dictionary
+        optional "batch_size" and "num_workers" of the extraction loader
     """
 
     def __init__(self, exp_path, params=None):
@@ -79,7 +88,9 @@ class ArchDataExtractor:
         """
 
         train_loader, num_classes = get_classification_dataset(exp_data=self.exp_data, train=True,
-                                                      shuffle_train=False, get_dataset=False)
+                                                      shuffle_train=False, get_dataset=False,
+                                                      batch_size=self.params.get("batch_size", 1),
+                                                      num_workers=self.params.get("num_workers"))
         self.train_loader = train_loader
         self.num_classes = num_classes
 
@@ -110,11 +121,14 @@ class ArchDataExtractor:
         full_loader: PyTorch dataloader, containing (images, images) over entire dataset.
         embedding_dim: Tuple (c, h, w) Dimension of embedding = output of encoder dimesntions.
         device: "cuda" or "cpu"
-        Returns: Embedding of size (num_images_in_loader + 1, c, h, w)
+        Fills self.embeddings, a (num_images_in_loader, embedding_dim) float32 matrix,
+        and self.image_names in the same order
         """
         # Set encoder to eval mode.
         self.cnn_model.eval()
 
+        num_images = len(self.train_loader.dataset)
+        start = 0
         # Again we do not compute loss here so. No gradients.
         with torch.no_grad():
             for batch_idx, (train_img, target_img, img_path) in enumerate(tqdm(self.train_loader)):
@@ -124,8 +138,13 @@ class ArchDataExtractor:
                 enc_output = self.cnn_model(train_img).cpu()
                 if len(enc_output.shape) == 4:
                     enc_output = enc_output.squeeze(-1).squeeze(-1)
+                enc_output = enc_output.reshape(enc_output.shape[0], -1).numpy()
+                if self.embeddings is None:
+                    self.embeddings = np.empty((num_images, enc_output.shape[1]), dtype=np.float32)
                 # Keep adding these outputs to embeddings.
-                self.retrieval_db[img_path] = enc_output
+                self.embeddings[start:start + enc_output.shape[0]] = enc_output
+                self.image_names.extend(img_path)
+                start += enc_output.shape[0]
 
         return
 
@@ -136,7 +155,8 @@ class ArchDataExtractor:
         The results are saved in a json file to then use for retrieval database purposes
         """
 
-        self.retrieval_db = {}
+        self.embeddings = None
+        self.image_names = []
         self.embedding_dim = 2048
 
         self.create_embedding()
@@ -145,29 +165,29 @@ class ArchDataExtractor:
 
     def save_retrieval_db(self):
         """
-        Saving the retrieval db into a pickle file
+        Saving the retrieval db as a contiguous float32 .npy matrix and the image paths
+        with lib.io.write_npy_descriptors, which data.utils.load_data memory-maps
         """
 
         database_root = CONFIG["paths"]["database_path"]
         create_directory(database_root)
         database_path = os.path.join(database_root,
                                      f"database_{self.exp_data['dataset']['dataset_name']}_"
-                                     f"{self.exp_data['model']['model_name']}_{self.exp_data['model']['layer']}.pkl")
-        with open(database_path, "wb") as file:
-            pickle.dump(self.retrieval_db, file)
+                                     f"{self.exp_data['model']['model_name']}_{self.exp_data['model']['layer']}")
+        write_npy_descriptors(self.embeddings, self.image_names, f"{database_path}.npy")
 
         return
 
 if __name__ == "__main__":
     os.system("clear")
-    exp_path = process_arguments()
+    exp_path, params = process_arguments()
 
     # initializing logger and logging the beggining of the experiment
     logger = Logger(exp_path)
     message = f"Starting to extract ArchData retrieval dataset."
     logger.log_info(message=message, message_type="new_exp")
 
-    extractor = ArchDataExtractor(exp_path=exp_path)
+    extractor = ArchDataExtractor(exp_path=exp_path, params=params)
     extractor.load_dataset()
     extractor.load_models()
     extractor.extract_retrieval_dataset()
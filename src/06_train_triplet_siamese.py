@@ -17,38 +17,9 @@ from src.lib.siamese.args import siamese_args
 from src.lib.siamese.dataset import generate_train_dataset, get_transforms, add_file_list
 from src.lib.augmentations import *
 from src.data.siamese_dataloader import TripletTrainList, TripletValList, ImageList
+from src.data.image_store import open_image_store
 from src.lib.siamese.model import TripletSiameseNetwork, TripletSiameseNetwork_custom
-
-
-def generate_features(args, net, data_loader):
-    if args.loss == "custom":
-        features_list = list()
-        with torch.no_grad():
-            if args.model == 'resnet50':
-                for no, data in enumerate(data_loader):
-                    images = data
-                    images = images.to(args.device)
-                    feats1, feats2, feats3, feats4 = net.forward_once(images)
-                    features_list.append(feats3.cpu().numpy())
-            elif args.model == 'vgg' or args.model == 'vgg_fc7':
-                for no, data in enumerate(data_loader):
-                    images = data
-                    images = images.to(args.device)
-                    _, _, _, _, feats5 = net.forward_once(images)
-                    features_list.append(feats5.cpu().numpy())
-        features = torch.Tensor(np.vstack(features_list))
-
-    else:
-        features_list = list()
-        with torch.no_grad():
-            for no, data in enumerate(data_loader):
-                images = data
-                images = images.to(args.device)
-                feats = net.forward_once(images)
-                features_list.append(feats.cpu().numpy())
-        features = torch.Tensor(np.vstack(features_list))
-
-    return features
+from src.lib.siamese.extraction import generate_features
 
 
 def train(args, augmentations_list):
@@ -57,6 +28,7 @@ def train(args, augmentations_list):
         print("hardware_image_description:", torch.cuda.get_device_name(0))
         # defining the transforms
     transforms = get_transforms(args)
+    store = open_image_store(args, transforms)
 
     if args.train_dataset == "image_collation":
         print("Used dataset: Image Collation")
@@ -123,12 +95,13 @@ def train(args, augmentations_list):
     val_list = []
     if args.train_dataset == 'the_MET':
         val_pairs = TripletTrainList(args.data_path, val_frame, transform=transforms, imsize=args.imsize,
-                                     argumentation=augmentations_list,mode='offline')
+                                     argumentation=augmentations_list,mode='offline', store=store)
     else:
         for j in range(len(query_val)):
             val_list.append((query_val[j], p_val[j], n_val[j]))
 
-        val_pairs = TripletValList(val_list, transform=transforms, imsize=args.imsize, argumentation=augmentations_list)
+        val_pairs = TripletValList(val_list, transform=transforms, imsize=args.imsize, argumentation=augmentations_list,
+                                  store=store)
     val_dataloader = DataLoader(dataset=val_pairs, shuffle=True, num_workers=args.num_workers,
                                 batch_size=args.batch_size)
 
@@ -231,18 +204,18 @@ def train(args, augmentations_list):
                 n_train_o = list(train_origin['ref_negative'])
                 logging.info("triplet list generated")
                 '''extract features of each triplets'''
-                query_o = ImageList(query_train_o, transform=transforms, imsize=args.imsize)
-                p_o = ImageList(p_train_o, transform=transforms, imsize=args.imsize)
-                n_o = ImageList(n_train_o, transform=transforms, imsize=args.imsize)
+                query_o = ImageList(query_train_o, transform=transforms, imsize=args.imsize, store=store)
+                p_o = ImageList(p_train_o, transform=transforms, imsize=args.imsize, store=store)
+                n_o = ImageList(n_train_o, transform=transforms, imsize=args.imsize, store=store)
                 query_dataloader = DataLoader(dataset=query_o, shuffle=False, num_workers=args.num_workers,
                                               batch_size=args.batch_size)
                 p_dataloader = DataLoader(dataset=p_o, shuffle=False, num_workers=args.num_workers,
                                           batch_size=args.batch_size)
                 n_dataloader = DataLoader(dataset=n_o, shuffle=False, num_workers=args.num_workers,
                                           batch_size=args.batch_size)
-                query_f_o = generate_features(args, net, query_dataloader)
-                p_f_o = generate_features(args, net, p_dataloader)
-                n_f_o = generate_features(args, net, n_dataloader)
+                query_f_o = torch.from_numpy(generate_features(args, net, query_dataloader))
+                p_f_o = torch.from_numpy(generate_features(args, net, p_dataloader))
+                n_f_o = torch.from_numpy(generate_features(args, net, n_dataloader))
                 logging.info("triplet list embedded")
 
                 '''calculate distances between each triplets'''
@@ -280,10 +253,11 @@ def train(args, augmentations_list):
 
         if args.train_dataset == 'the_MET':
             image_pairs = TripletTrainList(args.data_path, train_frame, transform=transforms, imsize=args.imsize,
-                                           argumentation=augmentations_list, mode=args.mining_mode)
+                                           argumentation=augmentations_list, mode=args.mining_mode, store=store)
             num_triplets = args.len
         else:
-            image_pairs = TripletValList(train_list, transform=transforms, imsize=args.imsize, argumentation=augmentations_list)
+            image_pairs = TripletValList(train_list, transform=transforms, imsize=args.imsize,
+                                         argumentation=augmentations_list, store=store)
         train_dataloader = DataLoader(dataset=image_pairs, shuffle=True, num_workers=args.num_workers,
                                       batch_size=args.batch_size)
 
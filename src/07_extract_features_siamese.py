@@ -1,8 +1,6 @@
 import os
 import glob
-import time
 import pandas as pd
-import numpy as np
 import torch
 import torchvision
 from torch.utils.data import DataLoader
@@ -15,76 +13,49 @@ from src.lib.siamese.args import siamese_args
 from src.lib.siamese.dataset import generate_extraction_dataset, generate_validation_dataset, get_transforms
 from src.lib.augmentations import *
 from src.data.siamese_dataloader import ImageList, ContrastiveValList
-from src.lib.siamese.model import TripletSiameseNetwork, TripletSiameseNetwork_custom
+from src.lib.siamese.cache import open_cache
+from src.data.image_store import open_image_store
+from src.lib.siamese.extraction import generate_features, generate_sharded_features, generate_split_features, \
+    generate_parallel_features, report_parallel_scaling, load_network, generate_multi_pool_features, \
+    generate_store_features
 from src.lib.utils import imshow
 from src.lib.io import *
 
 
-def generate_features(args, net, image_names, data_loader, save_path):
-    # images_list = list()
-    if args.loss == "custom":
-        features_list = list()
-        with torch.no_grad():
-            if args.model == 'resnet50':
-                t0 = time.time()
-                for no, data in enumerate(data_loader):
-                    images = data
-                    images = images.to(args.device)
-                    feats1, feats2, feats3, feats4 = net.forward_once(images)
-                    features_list.append(feats3.cpu().numpy())
-            elif args.model == 'vgg' or args.model == 'vgg_fc7':
-                t0 = time.time()
-                for no, data in enumerate(data_loader):
-                    images = data
-                    images = images.to(args.device)
-                    _, _, _, _, feats5 = net.forward_once(images)
-                    features_list.append(feats5.cpu().numpy())
-                # images_list.append(images.cpu().numpy())
-        t1 = time.time()
-        features = np.vstack(features_list)
-        write_pickle_descriptors(features, image_names, save_path)
-
+def extract_test_features(args, net, test_dataset, test_paths, save_path_test, cache=None):
+    """
+    embed the test images with the output mode selected by the arguments: one file per pooling
+    (--methods), the appendable store (--append_store), resumable shards (--shard_size),
+    cpu processes (--num_procs) or a single loader, the last two reusing cache
+    """
+    if args.report_scaling > 0:
+        report_parallel_scaling(args, test_dataset, args.report_scaling)
+    if args.methods is not None:
+        test_dataloader = DataLoader(dataset=test_dataset, shuffle=False, num_workers=args.num_workers,
+                                     batch_size=args.batch_size)
+        generate_multi_pool_features(args, net, test_dataloader, args.methods.split(','), test_paths,
+                                     save_path_test)
+    elif args.append_store:
+        generate_store_features(args, net, test_dataset, test_paths, save_path_test)
+    elif args.shard_size > 0:
+        generate_sharded_features(args, net, test_dataset, test_paths, save_path_test, args.shard_size)
+    elif args.num_procs > 1 and cache is None:
+        generate_parallel_features(args, test_dataset, test_paths, save_path_test)
     else:
-        features_list = list()
-        t0 = time.time()
-        with torch.no_grad():
-            for no, data in enumerate(data_loader):
-                images = data
-                images = images.to(args.device)
-                feats = net.forward_once(images)
-                features_list.append(feats.cpu().numpy())
-                # images_list.append(images.cpu().numpy())
-        t1 = time.time()
-        features = np.vstack(features_list)
-        write_pickle_descriptors(features, image_names, save_path)
-
-    print(f"writing descriptors to {save_path}")
-    print(f"image_description_time: {(t1 - t0) / len(image_names):.5f} s per image")
+        test_dataloader = DataLoader(dataset=test_dataset, shuffle=False, num_workers=args.num_workers,
+                                     batch_size=args.batch_size)
+        generate_features(args, net, test_dataloader, test_paths, save_path_test, cache=cache)
 
 
 def extract_features(args):
     # TODO: Returning the ground truth labels for a given dataset
     # defining the transforms
     transforms = get_transforms(args)
+    cache = open_cache(args, transforms)
+    store = open_image_store(args, transforms)
 
     # Loading the pretrained siamese model
-
-    if args.loss == "custom":
-        print('model trained with custom loss')
-        net = TripletSiameseNetwork_custom(args.model)
-    elif args.loss == "normal":
-        print('model trained with regular loss')
-        net = TripletSiameseNetwork(args.model, args.method)
-
-    try:
-        state_dict = torch.load(args.net + args.checkpoint)
-        net.load_state_dict(state_dict)
-        print('load trained model:{}'.format(args.net + args.checkpoint))
-    except:
-        pass
-
-    net.eval()
-    net.to(args.device)
+    net = load_network(args)
     # print("checkpoint {} loaded\n".format(args.checkpoint))
 
     if args.test_dataset == "image_collation":
@@ -95,49 +66,34 @@ def extract_features(args):
         d2_images = [args.d2 + 'illustration/' + l.strip() for l in open(args.d2 + 'files.txt', "r")]
         d3_images = [args.d3 + 'illustration/' + l.strip() for l in open(args.d3 + 'files.txt', "r")]
 
-        p1_dataset = ImageList(p1_images, transform=transforms)
-        p2_dataset = ImageList(p2_images, transform=transforms)
-        p3_dataset = ImageList(p3_images, transform=transforms)
-        d1_dataset = ImageList(d1_images, transform=transforms)
-        d2_dataset = ImageList(d2_images, transform=transforms)
-        d3_dataset = ImageList(d3_images, transform=transforms)
-
-        p1_loader = DataLoader(dataset=p1_dataset, shuffle=False, num_workers=args.num_workers,
-                               batch_size=args.batch_size)
-        p2_loader = DataLoader(dataset=p2_dataset, shuffle=False, num_workers=args.num_workers,
-                               batch_size=args.batch_size)
-        p3_loader = DataLoader(dataset=p3_dataset, shuffle=False, num_workers=args.num_workers,
-                               batch_size=args.batch_size)
-        d1_loader = DataLoader(dataset=d1_dataset, shuffle=False, num_workers=args.num_workers,
-                               batch_size=args.batch_size)
-        d2_loader = DataLoader(dataset=d2_dataset, shuffle=False, num_workers=args.num_workers,
-                               batch_size=args.batch_size)
-        d3_loader = DataLoader(dataset=d3_dataset, shuffle=False, num_workers=args.num_workers,
-                               batch_size=args.batch_size)
-
-        generate_features(args, net, p1_images, p1_loader, args.p1_f)
-        generate_features(args, net, p2_images, p2_loader, args.p2_f)
-        generate_features(args, net, p3_images, p3_loader, args.p3_f)
-        generate_features(args, net, d1_images, d1_loader, args.d1_f)
-        generate_features(args, net, d2_images, d2_loader, args.d2_f)
-        generate_features(args, net, d3_images, d3_loader, args.d3_f)
+        p1_dataset = ImageList(p1_images, transform=transforms, store=store)
+        p2_dataset = ImageList(p2_images, transform=transforms, store=store)
+        p3_dataset = ImageList(p3_images, transform=transforms, store=store)
+        d1_dataset = ImageList(d1_images, transform=transforms, store=store)
+        d2_dataset = ImageList(d2_images, transform=transforms, store=store)
+        d3_dataset = ImageList(d3_images, transform=transforms, store=store)
+
+        # one loader over the six splits, written back per split
+        generate_split_features(args, net,
+                                [p1_dataset, p2_dataset, p3_dataset, d1_dataset, d2_dataset, d3_dataset],
+                                [p1_images, p2_images, p3_images, d1_images, d2_images, d3_images],
+                                [args.p1_f, args.p2_f, args.p3_f, args.d1_f, args.d2_f, args.d3_f],
+                                cache=cache)
 
     elif args.test_dataset == "artdl" or args.test_dataset == "photoart50":
         save_path_test = args.exp_path + args.test_f
         # save_path_db = args.exp_path + args.db_f
         test_set = generate_test_list(args)
         test_paths = list(test_set['test_images'])
-        test_dataset = ImageList(test_paths, transform=transforms)
-        test_dataloader = DataLoader(dataset=test_dataset, shuffle=False, num_workers=args.num_workers,
-                               batch_size=args.batch_size)
-        generate_features(args, net, test_paths, test_dataloader, save_path_test)
+        test_dataset = ImageList(test_paths, transform=transforms, store=store)
+        extract_test_features(args, net, test_dataset, test_paths, save_path_test, cache)
         # db_file = args.data_path + args.db_list
         # sample_set = pd.read_csv(db_file)
         # sample_paths = list(sample_set['samples'])
         # sample_dataset = ImageList(sample_paths, transform=transforms)
         # sample_dataloader = DataLoader(dataset=sample_dataset, shuffle=False, num_workers=args.num_workers,
         #                              batch_size=args.batch_size)
-        # generate_features(args, net, sample_paths, sample_dataloader, save_path_db)
+        # generate_features(args, net, sample_dataloader, sample_paths, save_path_db)
 
     elif args.test_dataset == "the_MET":
         save_path_test = args.exp_path + args.test_f
@@ -147,10 +103,8 @@ def extract_features(args):
         test_list = []
         for ite in test_paths:
             test_list.append(args.data_path + ite)
-        test_dataset = ImageList(test_list, transform=transforms)
-        test_dataloader = DataLoader(dataset=test_dataset, shuffle=False, num_workers=args.num_workers,
-                                     batch_size=args.batch_size)
-        generate_features(args, net, test_paths, test_dataloader, save_path_test)
+        test_dataset = ImageList(test_list, transform=transforms, store=store)
+        extract_test_features(args, net, test_dataset, test_paths, save_path_test, cache)
 
     # creating the dataset
     #query_images, database_images, _ = generate_extraction_dataset(query, ref, ref)
@@ -164,8 +118,8 @@ def extract_features(args):
     # db_loader = DataLoader(dataset=database_dataset, shuffle=False, num_workers=args.num_workers,
     #                                       batch_size=args.batch_size)
 
-    # query_features = generate_features(args, net, query, query_loader, args.query_f)
-    # database_features = generate_features(args, net, ref, db_loader, args.db_f)
+    # query_features = generate_features(args, net, query_loader, query, args.query_f)
+    # database_features = generate_features(args, net, db_loader, ref, args.db_f)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,4 @@
 import sys
-import torch
 import numpy as np
 sys.path.append('/cluster/yinan/yinan_cnn/cnn_similarity_analysis/')
 import pandas as pd
@@ -15,6 +14,15 @@ def reshape_feature_map(input_map):
     return output_map
 
 
+def location_descriptors(vectors):
+    """
+    (N, H*W, C) location descriptors, chunked feature maps are already stored that way and stay on disk
+    """
+    if isinstance(vectors, FeatureMaps):
+        return vectors
+    return reshape_feature_map(np.asarray(vectors))
+
+
 def evaluation(args):
     # q_names, q_vectors = read_pickle_descriptors(args.query_f)
     # db_names, db_vectors = read_pickle_descriptors(args.db_f)
@@ -27,22 +35,22 @@ def evaluation(args):
         gt_d2d3 = read_config(args.gt_list + 'D2-D3.json')
         gt_d1d3 = read_config(args.gt_list + 'D1-D3.json')
 
-        p1_names, p1_vectors = read_pickle_descriptors(args.p1_f)
-        p2_names, p2_vectors = read_pickle_descriptors(args.p2_f)
-        p3_names, p3_vectors = read_pickle_descriptors(args.p3_f)
-        d1_names, d1_vectors = read_pickle_descriptors(args.d1_f)
-        d2_names, d2_vectors = read_pickle_descriptors(args.d2_f)
-        d3_names, d3_vectors = read_pickle_descriptors(args.d3_f)
+        p1_names, p1_vectors = load_descriptors(args.p1_f)
+        p2_names, p2_vectors = load_descriptors(args.p2_f)
+        p3_names, p3_vectors = load_descriptors(args.p3_f)
+        d1_names, d1_vectors = load_descriptors(args.d1_f)
+        d2_names, d2_vectors = load_descriptors(args.d2_f)
+        d3_names, d3_vectors = load_descriptors(args.d3_f)
 
-        if p1_vectors.ndim == 4:
+        if isinstance(p1_vectors, FeatureMaps) or p1_vectors.ndim == 4:
             if args.method == 'matching_based':
                 sigma = 2
-                p1_vectors = reshape_feature_map(p1_vectors)
-                p2_vectors = reshape_feature_map(p2_vectors)
-                p3_vectors = reshape_feature_map(p3_vectors)
-                d1_vectors = reshape_feature_map(d1_vectors)
-                d2_vectors = reshape_feature_map(d2_vectors)
-                d3_vectors = reshape_feature_map(d3_vectors)
+                p1_vectors = location_descriptors(p1_vectors)
+                p2_vectors = location_descriptors(p2_vectors)
+                p3_vectors = location_descriptors(p3_vectors)
+                d1_vectors = location_descriptors(d1_vectors)
+                d2_vectors = location_descriptors(d2_vectors)
+                d3_vectors = location_descriptors(d3_vectors)
                 confidence_p1p2, correct_p1p2, accuracy_p1p2 = feature_location_matching(gt_p1p2, p1_vectors, p2_vectors, sigma)
                 confidence_p2p3, correct_p2p3, accuracy_p2p3 = feature_location_matching(gt_p2p3, p2_vectors, p3_vectors, sigma)
                 confidence_p1p3, correct_p1p3, accuracy_p1p3 = feature_location_matching(gt_p1p3, p1_vectors, p3_vectors, sigma)
@@ -91,19 +99,15 @@ def evaluation(args):
         print('Dataset to be evaluate: ArtDL')
         test_features = args.exp_path + args.test_f
         print('test file {} will be loaded'.format(test_features))
-        test_names, test_vectors = read_pickle_descriptors(test_features)
+        test_names, test_vectors = load_descriptors(test_features)
         test_file_path = args.data_path + args.test_list
         test_file = pd.read_csv(test_file_path)
         labels = list(test_file['label_encoded'])
-        test_vectors = torch.Tensor(test_vectors).to(args.device)
 
         gt_array = np.array(labels)
-        r_5 = ranked_recall(gt_array, test_vectors, 5)
-        r_20 = ranked_recall(gt_array, test_vectors, 20)
-        r_50 = ranked_recall(gt_array, test_vectors, 50)
-        map_10 = ranked_mean_precision(args, gt_array, test_vectors, 10)
-        map_20 = ranked_mean_precision(args, gt_array, test_vectors, 20)
-        map_50 = ranked_mean_precision(args, gt_array, test_vectors, 50)
+        (r_5, r_20, r_50), (map_10, map_20, map_50) = ranked_metrics(
+            gt_array, test_vectors, recall_ranks=(5, 20, 50), map_ranks=(10, 20, 50),
+            num_classes=RANKED_NUM_CLASSES[args.test_dataset])
         print('r[5]: {}'.format(r_5))
         print('r[20]: {}'.format(r_20))
         print('r[50]: {}'.format(r_50))
@@ -4,47 +4,19 @@ import numpy as np
 import pandas as pd
 import torch
 import torch.nn.functional as F
-import time
 from torch.utils.data import DataLoader
 from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
 from src.lib.siamese.args import siamese_args
 from src.lib.siamese.model import load_siamese_checkpoint, TripletSiameseNetwork, TripletSiameseNetwork_custom
 from src.data.siamese_dataloader import ImageList
 from src.lib.siamese.dataset import get_transforms
+from src.lib.siamese.extraction import generate_features
 from lib.io import read_config
 from lib.metrics import calculate_distance
 import faiss
 import random
 
 
-def generate_features(args, net, image_names, data_loader):
-    features_list = list()
-    # images_list = image_names
-    if args.loss == 'normal':
-        t0 = time.time()
-        with torch.no_grad():
-            for no, data in enumerate(data_loader):
-                images = data
-                images = images.to(args.device)
-                feats = net.forward_once(images)
-                features_list.append(feats.cpu().numpy())
-                # images_list.append(images.cpu().numpy())
-        t1 = time.time()
-    elif args.loss == 'custom':
-        t0 = time.time()
-        with torch.no_grad():
-            for no, data in enumerate(data_loader):
-                images = data
-                images = images.to(args.device)
-                feats1, feats2, feats3, feats4, feats5 = net.forward_once(images)
-                features_list.append(feats5.cpu().numpy())
-                # images_list.append(images.cpu().numpy())
-        t1 = time.time()
-    features = np.vstack(features_list)
-    print(f"image_description_time: {(t1 - t0) / len(image_names):.5f} s per image")
-    return features
-
-
 def train(args):
     if args.device == "gpu":
         print("hardware_image_description:", torch.cuda.get_device_name(0))
@@ -80,7 +52,7 @@ def train(args):
     net.to(args.device)
     net.eval()
 
-    train_features = generate_features(args, net, train_images, train_loader)
+    train_features = generate_features(args, net, train_loader)
 
     d = train_features.shape[1]
     pca = faiss.PCAMatrix(d, args.pca_dim, -0.5)
@@ -99,7 +71,7 @@ def train(args):
         val_dataset = ImageList(val_images, transform=transforms)
         val_loader = DataLoader(dataset=val_dataset, shuffle=False, num_workers=args.num_workers,
                                 batch_size=args.batch_size)
-        val_features = generate_features(args, net, val_images, val_loader)
+        val_features = generate_features(args, net, val_loader)
 
         if args.pca:
             d1_features = pca.apply_py(val_features[:len(d1_images)])
@@ -138,9 +110,9 @@ def train(args):
                                   batch_size=args.batch_size)
         n_val_loader = DataLoader(dataset=n_val_list, shuffle=False, num_workers=args.num_workers,
                                   batch_size=args.batch_size)
-        query_val_features = generate_features(args, net, query_val, query_val_loader)
-        p_val_features = generate_features(args, net, p_val, p_val_loader)
-        n_val_features = generate_features(args, net, n_val, n_val_loader)
+        query_val_features = generate_features(args, net, query_val_loader)
+        p_val_features = generate_features(args, net, p_val_loader)
+        n_val_features = generate_features(args, net, n_val_loader)
 
         if args.pca:
             query_val_features = pca.apply_py(query_val_features)
@@ -17,28 +17,10 @@ from src.lib.siamese.dataset import generate_train_dataset, get_transforms, add_
 from src.lib.augmentations import *
 from src.data.siamese_dataloader import TripletTrainList, TripletValList, ImageList
 from src.lib.siamese.model import TripletSiameseNetwork, TripletSiameseNetwork_custom
+from src.lib.siamese.extraction import generate_features
 from src.lib.metrics import *
 
 
-def generate_features(args, net, data_loader):
-    features_list = list()
-    with torch.no_grad():
-        if args.model == 'resnet50':
-            for no, data in enumerate(data_loader):
-                images = data
-                images = images.to(args.device)
-                feats1, feats2, feats3, feats4 = net.forward_once(images)
-                features_list.append(feats3.cpu().numpy())
-        elif args.model == 'vgg' or args.model == 'vgg_fc7':
-            for no, data in enumerate(data_loader):
-                images = data
-                images = images.to(args.device)
-                _, _, _, _, _, feats6 = net.forward_once(images)
-                features_list.append(feats6.cpu().numpy())
-    features = torch.Tensor(np.vstack(features_list))
-    return features
-
-
 def train(args, augmentations_list, lam):
     if args.device == "gpu":
         print("hardware_image_description:", torch.cuda.get_device_name(0))
@@ -169,9 +151,9 @@ def train(args, augmentations_list, lam):
                                           batch_size=args.batch_size)
                 n_dataloader = DataLoader(dataset=n_o, shuffle=False, num_workers=args.num_workers,
                                           batch_size=args.batch_size)
-                query_f_o = generate_features(args, net, query_dataloader)
-                p_f_o = generate_features(args, net, p_dataloader)
-                n_f_o = generate_features(args, net, n_dataloader)
+                query_f_o = torch.from_numpy(generate_features(args, net, query_dataloader))
+                p_f_o = torch.from_numpy(generate_features(args, net, p_dataloader))
+                n_f_o = torch.from_numpy(generate_features(args, net, n_dataloader))
 
                 '''calculate distances between each triplets'''
                 query_f_o.to(args.device)
@@ -215,9 +197,9 @@ def train(args, augmentations_list, lam):
                                       batch_size=args.batch_size)
             n_dataloader = DataLoader(dataset=n_o, shuffle=False, num_workers=args.num_workers,
                                       batch_size=args.batch_size)
-            query_f_o = generate_features(args, net, query_dataloader)
-            p_f_o = generate_features(args, net, p_dataloader)
-            n_f_o = generate_features(args, net, n_dataloader)
+            query_f_o = torch.from_numpy(generate_features(args, net, query_dataloader))
+            p_f_o = torch.from_numpy(generate_features(args, net, p_dataloader))
+            n_f_o = torch.from_numpy(generate_features(args, net, n_dataloader))
 
             '''calculate distances between each triplets'''
             query_f_o.to(args.device)
@@ -277,9 +259,9 @@ def train(args, augmentations_list, lam):
 
         # Validating over batches
         net.eval()
-        val_features = generate_features(args, net, val_dataloader)
+        val_features = torch.from_numpy(generate_features(args, net, val_dataloader))
         val_features = val_features.cuda()
-        map_10 = ranked_mean_precision(gt_array, val_features, 10)
+        map_10 = ranked_mean_precision(args, gt_array, val_features, 10)
 
         print("Epoch:{},  Current map {}\n".format(epoch, map_10))
 
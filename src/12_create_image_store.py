@@ -0,0 +1,49 @@
+import os
+import pandas as pd
+import sys
+sys.path.append('/cluster/yinan/yinan_cnn/cnn_similarity_analysis/')
+
+from src.lib.siamese.args import siamese_args
+from src.lib.siamese.dataset import get_transforms
+from src.data.image_store import build_image_store
+from src.lib.io import generate_test_list
+
+
+def collect_image_paths(args):
+    """
+    paths of the images read by 06 and 07 for the configured train and test datasets,
+    spelled the way those scripts spell them so the store lookups hit
+    """
+    paths = []
+    datasets = {args.train_dataset, args.test_dataset}
+    if "image_collation" in datasets:
+        for folder in [args.p1, args.p2, args.p3, args.d1, args.d2, args.d3]:
+            paths += [folder + 'illustration/' + l.strip() for l in open(folder + 'files.txt', "r")]
+
+    if datasets & {"artdl", "photoart50", "iconart"}:
+        for triplet_list in [args.train_list, args.val_list]:
+            if triplet_list is not None and os.path.exists(args.data_path + triplet_list):
+                triplets = pd.read_csv(args.data_path + triplet_list)
+                for column in ['anchor_query', 'ref_positive', 'ref_negative']:
+                    if column in triplets:
+                        paths += list(triplets[column])
+        if args.test_list is not None:
+            paths += list(generate_test_list(args)['test_images'])
+
+    if "the_MET" in datasets:
+        for frame_list in [args.train_list, args.val_list]:
+            if frame_list is not None:
+                paths += [args.data_path + 'images/' + path for path in pd.read_csv(args.data_path + frame_list)['path']]
+        if args.test_list is not None:
+            paths += [args.data_path + path for path in pd.read_csv(args.data_path + args.test_list)['path']]
+    return paths
+
+
+if __name__ == "__main__":
+
+    siamese_args = siamese_args()
+    if siamese_args.image_store is None:
+        raise ValueError("--image_store is the folder the store is written to")
+    transforms = get_transforms(siamese_args)
+    build_image_store(collect_image_paths(siamese_args), transforms, siamese_args.image_store,
+                      num_workers=max(siamese_args.num_workers, 1))
@@ -0,0 +1,29 @@
+import os
+import argparse
+import sys
+sys.path.append('/cluster/yinan/yinan_cnn/cnn_similarity_analysis/')
+
+from src.lib.io import load_descriptors, write_npy_descriptors, descriptor_names_file
+
+
+def convert_descriptors(fname, output=None):
+    """
+    rewrite a pickle (or .h5 / sharded) descriptor file as a memory-mappable .npy block
+    with its names index next to it
+    """
+    output = output if output is not None else os.path.splitext(fname.rstrip('/'))[0] + '.npy'
+    image_names, vectors = load_descriptors(fname, mmap=False)
+    write_npy_descriptors(vectors, image_names, output)
+    print(f"{fname} -> {output} ({vectors.shape[0]} descriptors, names in {descriptor_names_file(output)})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert descriptor files to the .npy format')
+    parser.add_argument('files', nargs='+', help='descriptor files to convert')
+    parser.add_argument('--output', default=None, help='output .npy file, only with a single input file')
+    args = parser.parse_args()
+    if args.output is not None and len(args.files) > 1:
+        parser.error('--output needs a single input file')
+
+    for fname in args.files:
+        convert_descriptors(fname, args.output)
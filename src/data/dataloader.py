@@ -85,7 +85,7 @@ class FolderDataset(VisionDataset):
     def __len__(self):
         return len(self.samples)
 
-def get_dataset_loader(dataset, batch_size=64, shuffle=False):
+def get_dataset_loader(dataset, batch_size=64, shuffle=False, num_workers=None):
     """
     Fitting a dataset split into a data loader
     Args:
@@ -96,19 +96,23 @@ def get_dataset_loader(dataset, batch_size=64, shuffle=False):
         number of elements in each batch
     shuffle: boolean
         if True, images are accessed randomly
+    num_workers: integer
+        number of loading processes, CONFIG["num_workers"] if None
     Returns:
     --------
     data_loader: DataLoader
         data loader to iterate the dataset split using batches
     """
 
+    num_workers = CONFIG["num_workers"] if num_workers is None else num_workers
     data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
-                             num_workers=CONFIG["num_workers"])
+                             num_workers=num_workers)
 
     return data_loader
 
 
-def get_classification_dataset(exp_data, train=True, shuffle_train=False, get_dataset=False):
+def get_classification_dataset(exp_data, train=True, shuffle_train=False, get_dataset=False, batch_size=1,
+                               num_workers=None):
     """
     Loading the detection dataset and fitting data loaders to iterate the different splits
     Args:
@@ -121,6 +125,11 @@ def get_classification_dataset(exp_data, train=True, shuffle_train=False, get_da
         if True, images are accessed randomly
     class_ids: list of integers
         list containing the ids of the classes to detect. By defaul [1] (person class)
+    batch_size: integer
+        number of images in each batch. Above 1 the images are resized to
+        exp_data["dataset"]["image_size"] so that they can be stacked
+    num_workers: integer
+        number of loading processes, CONFIG["num_workers"] if None
     Returns:
     --------
     train_loader: DataLoader
@@ -130,7 +139,6 @@ def get_classification_dataset(exp_data, train=True, shuffle_train=False, get_da
     """
 
     data_path = CONFIG["paths"]["data_path"]
-    batch_size = 1
     dataset_name = exp_data["dataset"]["dataset_name"]
 
     train_loader, valid_loader = None, None
@@ -142,15 +150,17 @@ def get_classification_dataset(exp_data, train=True, shuffle_train=False, get_da
 
     if (train):
         if (dataset_name == "chrisarch"):
+            transform = [transforms.ToTensor()]
+            if (batch_size > 1):
+                image_size = exp_data["dataset"]["image_size"]
+                transform.insert(0, transforms.Resize((image_size, image_size)))
             dataset = FolderDataset(root=data_path,
                                     loader=default_loader,
                                     extensions=IMG_EXTENSIONS,
-                                    transform=transforms.Compose([
-                                            transforms.ToTensor(),
-                                        ])
+                                    transform=transforms.Compose(transform)
                                     )
 
-        train_loader = get_dataset_loader(dataset, batch_size, shuffle_train)
+        train_loader = get_dataset_loader(dataset, batch_size, shuffle_train, num_workers)
         train_set = dataset
 
 
@@ -0,0 +1,110 @@
+import os
+import json
+import numpy as np
+import torch
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+STORE_IMAGES = "images.npy"
+STORE_INDEX = "index.json"
+
+
+def _decode(path, resize):
+    return np.asarray(resize(Image.open(path).convert("RGB")), dtype=np.uint8)
+
+
+def build_image_store(paths, transforms, store_dir, num_workers=8):
+    """
+    decode every image of paths once, apply the resize/crop step of transforms (the first one
+    of a get_transforms Compose) and write the uint8 pixels to one (N, H, W, 3) memory mapped
+    array in store_dir, with an index of the paths and the transforms it was built for
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    paths = [str(path) for path in dict.fromkeys(paths)]
+    resize = transforms.transforms[0]
+    normalize = transforms.transforms[-1]
+
+    first = _decode(paths[0], resize)
+    tmp_path = os.path.join(store_dir, STORE_IMAGES + ".tmp.npy")
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(paths),) + first.shape)
+    chunk = 1024
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for start in range(0, len(paths), chunk):
+            for i, pixels in enumerate(executor.map(lambda p: _decode(p, resize), paths[start:start + chunk])):
+                images[start + i] = pixels
+            print(f"{min(start + chunk, len(paths))}/{len(paths)} images stored")
+    images.flush()
+    del images
+    os.replace(tmp_path, os.path.join(store_dir, STORE_IMAGES))
+
+    index = {'paths': paths, 'transform': repr(transforms),
+             'mean': [float(m) for m in normalize.mean], 'std': [float(s) for s in normalize.std]}
+    with open(os.path.join(store_dir, STORE_INDEX), 'w') as f:
+        json.dump(index, f)
+    print(f"image store of {len(paths)} images {first.shape} written to {store_dir}")
+
+
+class ImageStore:
+    """
+    read side of build_image_store. Images are looked up by path and sliced from the memory
+    mapped array without decoding; the array is opened lazily so the store can be handed to
+    DataLoader workers
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, STORE_INDEX), 'r') as f:
+            index = json.load(f)
+        self.paths = index['paths']
+        self.row = {path: i for i, path in enumerate(self.paths)}
+        self.transform = index['transform']
+        self.mean = torch.tensor(index['mean']).view(3, 1, 1)
+        self.std = torch.tensor(index['std']).view(3, 1, 1)
+        self._images = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return str(path) in self.row
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(os.path.join(self.store_dir, STORE_IMAGES), mmap_mode='r')
+        return self._images
+
+    def array(self, path):
+        """ (H, W, 3) uint8 view of the stored image """
+        return self.images[self.row[str(path)]]
+
+    def pil(self, path):
+        """ the stored image as a PIL image, for datasets applying augmentations """
+        return Image.fromarray(self.array(path))
+
+    def tensor(self, path):
+        """ the stored image after ToTensor and Normalize, same as transforms(Image.open(path)) """
+        x = torch.from_numpy(np.array(self.array(path))).permute(2, 0, 1).float().div_(255)
+        return (x - self.mean) / self.std
+
+    def check(self, transforms):
+        if repr(transforms) != self.transform:
+            raise ValueError(f"image store {self.store_dir} was built for {self.transform}, "
+                             f"not {repr(transforms)}")
+
+
+def open_image_store(args, transforms):
+    """
+    the ImageStore of args.image_store checked against transforms, None if not configured
+    """
+    if getattr(args, 'image_store', None) is None:
+        return None
+    store = ImageStore(args.image_store)
+    store.check(transforms)
+    print(f"reading {len(store)} pre-resized images from {args.image_store}")
+    return store
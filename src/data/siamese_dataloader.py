@@ -6,18 +6,29 @@ from src.lib.augmentations import *
 import pandas as pd
 
 
+def open_image(path, store=None):
+    """ RGB image of path, taken from the pre-resized ImageStore when it holds it """
+    if store is not None and path in store:
+        return store.pil(path)
+    return Image.open(path).convert("RGB")
+
+
 class ImageList(Dataset):
 
-    def __init__(self, image_list, imsize=None, transform=None):
+    def __init__(self, image_list, imsize=None, transform=None, store=None):
         Dataset.__init__(self)
         self.image_list = image_list
         self.transform = transform
         self.imsize = imsize
+        self.store = store
 
     def __len__(self):
         return len(self.image_list)
 
     def __getitem__(self, i):
+        if self.store is not None and self.image_list[i] in self.store:
+            # already resized for this transform, no decoding
+            return self.store.tensor(self.image_list[i])
         x = Image.open(self.image_list[i])
         x = x.convert("RGB")
         if self.transform is not None:
@@ -48,9 +59,11 @@ class ImageList_with_label(Dataset):
 
 class TripletTrainList(Dataset):
 
-    def __init__(self, image_path, train_frame, imsize=None, transform=None, argumentation=None, mode='offline'):
+    def __init__(self, image_path, train_frame, imsize=None, transform=None, argumentation=None, mode='offline',
+                 store=None):
         Dataset.__init__(self)
         self.mode = mode
+        self.store = store
         self.train_frame = train_frame
         self.image_path = image_path
         self.image_list = list(train_frame['path'])
@@ -71,15 +84,13 @@ class TripletTrainList(Dataset):
         # random.shuffle(self.argumentation)
         # argument = Compose(self.argumentation)
         label = self.train_frame['MET_id'][i]
-        db_positive = Image.open(self.image_list[i])
-        db_positive = db_positive.convert("RGB")
+        db_positive = open_image(self.image_list[i], self.store)
         if self.mode == 'offline':
             if self.frequencies[i] == 1:
                 query_image = self.argumentation(db_positive)
                 sub_list = self.image_list.copy()
                 sub_list.remove(self.image_list[i])
-                db_negative = Image.open(random.choice(sub_list))
-                db_negative = db_negative.convert("RGB")
+                db_negative = open_image(random.choice(sub_list), self.store)
             else:
                 sub_f_p = self.train_frame[self.train_frame['MET_id'] == label]
                 sub_f_n = self.train_frame[self.train_frame['MET_id'] != label]
@@ -90,16 +101,13 @@ class TripletTrainList(Dataset):
                 sub_list_n = list(sub_f_n['path'])
                 for j in range(len(sub_list_n)):
                     sub_list_n[j] = self.image_path + 'images/' + sub_list_n[j]
-                query_image = Image.open(random.choice(sub_list_p))
-                db_negative = Image.open(random.choice(sub_list_n))
-                query_image = query_image.convert("RGB")
-                db_negative = db_negative.convert("RGB")
+                query_image = open_image(random.choice(sub_list_p), self.store)
+                db_negative = open_image(random.choice(sub_list_n), self.store)
         else:
             query_image = self.argumentation(db_positive)
             sub_list = self.image_list.copy()
             sub_list.remove(self.image_list[i])
-            db_negative = Image.open(random.choice(sub_list))
-            db_negative = db_negative.convert("RGB")
+            db_negative = open_image(random.choice(sub_list), self.store)
 
         if self.transform is not None:
             query_image = self.transform(query_image)
@@ -110,12 +118,13 @@ class TripletTrainList(Dataset):
 
 class TripletValList(Dataset):
 
-    def __init__(self, image_list, imsize=None, transform=None, argumentation=None):
+    def __init__(self, image_list, imsize=None, transform=None, argumentation=None, store=None):
         Dataset.__init__(self)
         self.image_list = image_list
         self.transform = transform
         self.argumentation = argumentation
         self.imsize = imsize
+        self.store = store
 
     def __len__(self):
         return len(self.image_list)
@@ -124,13 +133,11 @@ class TripletValList(Dataset):
         random.shuffle(self.argumentation)
         argument = Compose(self.argumentation)
         q, r_p, r_n = self.image_list[i]
-        query_image = Image.open(q)
-        db_positive = Image.open(r_p)
+        query_image = open_image(q, self.store)
+        db_positive = open_image(r_p, self.store)
         db_positive = argument(db_positive)
-        db_negative = Image.open(r_n)
-        query_image = query_image.convert("RGB")
+        db_negative = open_image(r_n, self.store)
         db_positive = db_positive.convert("RGB")
-        db_negative = db_negative.convert("RGB")
         if self.transform is not None:
             query_image = self.transform(query_image)
             db_positive = self.transform(db_positive)
@@ -3,18 +3,22 @@ import pickle
 import numpy as np
 from CONFIG import CONFIG
 from lib.logger import Logger, log_function, print_
+from lib.io import read_npy_descriptors
 
 def load_data(dataset_name, model_name, layer):
     """
-    Loading pickled objects
+    Loading the retrieval database written by 02_create_archdata_retrieval.py. The .npy
+    matrix is memory-mapped; databases pickled by older versions are still read
     Args:
     -----
     dataset_names: list
         list with the datasets to fit into the knn structure
     Returns:
     --------
-    data: dictionary
-        dictionary containing data and metadata from all desired datasets
+    data: np.ndarray
+        (num_images, embedding_dim) matrix, one row per image
+    image_filenames: list
+        image path of every row of data
     """
 
     all_dicts = []
@@ -22,6 +26,13 @@ def load_data(dataset_name, model_name, layer):
 
 
     # loading data from all datasets
+    npy_path = os.path.join(CONFIG["paths"]["database_path"], f"database_{dataset_name}_{model_name}_{layer}.npy")
+    if os.path.exists(npy_path):
+        print_(f"Loading the database_{dataset_name}_{model_name}_{layer}.npy")
+        image_filenames, data = read_npy_descriptors(npy_path)
+        image_filenames = list(image_filenames)
+        return data, image_filenames
+
     pickle_path = os.path.join(CONFIG["paths"]["database_path"], f"database_{dataset_name}_{model_name}_{layer}.pkl")
     print_(f"Loading the database_{dataset_name}_{model_name}_{layer}.pkl")
 
@@ -3,6 +3,7 @@
 
 from typing import Iterable, List, Optional
 
+import os
 import json
 import numpy as np
 import h5py
@@ -11,7 +12,7 @@ import pandas as pd
 from pandas.core.frame import DataFrame
 import random
 
-from .metrics import GroundTruthMatch, PredictedMatch
+from .metrics import GroundTruthMatch, PredictedMatch, GroundTruthArrays, PredictionArrays
 
 
 def read_config(cfg_path):
@@ -47,21 +48,84 @@ def read_ground_truth(filename: str) -> List[GroundTruthMatch]:
     return gt_pairs
 
 
+def read_ground_truth_arrays(filename: str) -> GroundTruthArrays:
+    """
+    Read groundtruth csv file as GroundTruthArrays, same rules as read_ground_truth.
+    """
+    frame = pd.read_csv(filename, header=None, names=["query_id", "reference_id"], dtype=str,
+                        keep_default_na=False, na_filter=False)
+    header = (frame["query_id"] == "query_id") & (frame["reference_id"] == "reference_id")
+    frame = frame[~header & (frame["reference_id"] != "")]
+    return GroundTruthArrays.from_columns(frame["query_id"].values, frame["reference_id"].values)
+
+
+def _read_prediction_columns(filename: str):
+    """
+    query ids, reference ids and float scores of a predictions csv file, header lines dropped,
+    or of a binary .npz file of _write_prediction_columns
+    """
+    if filename.endswith(".npz"):
+        with np.load(filename) as data:
+            return (data["query_ids"][data["query"]], data["db_ids"][data["db"]],
+                    data["score"].astype(np.float64))
+    frame = pd.read_csv(filename, header=None, names=["query_id", "reference_id", "score"], dtype=str,
+                        keep_default_na=False, na_filter=False)
+    header = ((frame["query_id"] == "query_id") & (frame["reference_id"] == "reference_id")
+              & (frame["score"] == "score"))
+    if header.any():
+        frame = frame[~header]
+    return frame["query_id"].values, frame["reference_id"].values, frame["score"].values.astype(np.float64)
+
+
 def read_predictions(filename: str) -> List[PredictedMatch]:
     """
     Read predictions csv file.
     Must contain query_image_id,db_image_id,score on each line.
     Header optional
+    A .npz file is read as the binary format of write_predictions_from_arrays.
     """
-    predictions = []
-    with open(filename, "r") as cfile:
-        for line in cfile:
-            line = line.strip()
-            if line == "query_id,reference_id,score":
-                continue
-            q, db, score = line.split(",")
-            predictions.append(PredictedMatch(q, db, float(score)))
-    return predictions
+    queries, dbs, scores = _read_prediction_columns(filename)
+    return [PredictedMatch(q, db, score) for q, db, score in zip(queries, dbs, scores.tolist())]
+
+
+def read_prediction_arrays(filename: str) -> PredictionArrays:
+    """
+    Read a predictions csv file or a binary .npz file as PredictionArrays,
+    without building one PredictedMatch per line.
+    """
+    if filename.endswith(".npz"):
+        with np.load(filename) as data:
+            return PredictionArrays(data["query_ids"], data["db_ids"], data["query"], data["db"], data["score"])
+    return PredictionArrays.from_columns(*_read_prediction_columns(filename))
+
+
+def write_prediction_arrays(predictions: PredictionArrays, preds_filepath: str):
+    """
+    Write PredictionArrays as a binary .npz file or, for any other extension,
+    as a predictions csv file.
+    """
+    if preds_filepath.endswith(".npz"):
+        np.savez(preds_filepath, query_ids=predictions.query_ids.astype(str), db_ids=predictions.db_ids.astype(str),
+                 query=predictions.query, db=predictions.db, score=predictions.score)
+        return
+    _write_prediction_columns(predictions.query_ids[predictions.query], predictions.db_ids[predictions.db],
+                              predictions.score, preds_filepath, header=True)
+
+
+def _write_prediction_columns(queries, dbs, scores, preds_filepath: str, header: bool = False):
+    """
+    query_id,reference_id,score rows, scores with 6 decimals. A .npz path is written in binary:
+    sorted query and reference id tables, int32 indices into them and float32 scores
+    """
+    if preds_filepath.endswith(".npz"):
+        query_ids, query = np.unique(np.asarray(queries, dtype=str), return_inverse=True)
+        db_ids, db = np.unique(np.asarray(dbs, dtype=str), return_inverse=True)
+        np.savez(preds_filepath, query_ids=query_ids, db_ids=db_ids, query=query.astype(np.int32).ravel(),
+                 db=db.astype(np.int32).ravel(), score=np.asarray(scores, dtype=np.float32))
+        return
+    frame = pd.DataFrame({"query_id": queries, "reference_id": dbs, "score": scores})
+    with open(preds_filepath, "w") as pfile:
+        frame.to_csv(pfile, header=header, index=False, float_format="%.6f")
 
 
 def write_predictions(
@@ -100,7 +164,7 @@ def write_predictions_from_arrays(
     qids : np.ndarray
         Image ids for each query image. Shape [nq, ]
     preds_filepath : str
-        Output file path.
+        Output file path, a .npz path writes a binary file (integer ids and float32 scores).
     nmax : Optional[int], optional
         Maximum number of predictions to write. Will pick the ones with highest score.
         If None, no limit on the number of predictions.
@@ -121,18 +185,13 @@ def write_predictions_from_arrays(
         scores[o[:pivot]] = -1e7
         score_min = -1e6
 
-    with open(preds_filepath, "w") as pfile:
-        for qidx in range(nq):
-            query_id = qids[qidx]
-            for score, dbidx in zip(S[qidx], I[qidx]):
-                db_id = dbids[dbidx]
-                if score >= score_min:
-                    row = f"{query_id},{db_id},{score:.6f}"
-                    pfile.write(row + "\n")
-                else:
-                    # Assume scores are in decreasing order in the array
-                    # next scores on this row won't pass the threshold
-                    break
+    # Assume scores are in decreasing order in the array: a row stops at its first
+    # score below the threshold
+    keep = np.cumprod(S >= score_min, axis=1).astype(bool)
+    qidx, rank = np.nonzero(keep)
+    queries = np.asarray(qids)[qidx]
+    dbs = np.asarray(dbids)[I[qidx, rank]]
+    _write_prediction_columns(queries, dbs, S[qidx, rank], preds_filepath)
 
 
 def write_predictions_from_range_arrays(
@@ -160,7 +219,7 @@ def write_predictions_from_range_arrays(
     qids : np.ndarray
         Image ids for each query image. Shape [nq, ]
     preds_filepath : str
-        Output file path.
+        Output file path, a .npz path writes a binary file (integer ids and float32 scores).
     nmax : Optional[int], optional
         Maximum number of predictions to write. Will pick the ones with highest score.
         If None, no limit on the number of predictions.
@@ -180,16 +239,11 @@ def write_predictions_from_range_arrays(
         scores[o[:pivot]] = -1e7
         score_min = -1e6
 
-    with open(preds_filepath, "w") as pfile:
-        for qidx in range(nq):
-            l0, l1 = lims[qidx:qidx + 2]
-            query_id = qids[qidx]
-            for dbidx in range(l0, l1):
-                db_id = dbids[I[dbidx]]
-                score = S[dbidx]
-                if score > score_min:
-                    row = f"{query_id},{db_id},{score:.6f}"
-                    pfile.write(row + "\n")
+    qidx = np.repeat(np.arange(nq), np.diff(lims))
+    keep = S > score_min
+    queries = np.asarray(qids)[qidx[keep]]
+    dbs = np.asarray(dbids)[I[keep]]
+    _write_prediction_columns(queries, dbs, S[keep], preds_filepath)
 
 
 def write_hdf5_descriptors(vectors, image_names, fname):
@@ -278,6 +332,422 @@ def read_descriptors(filenames):
     ]
     return names, np.vstack(descs)
 
+
+def fit_location_pca(maps, dim, num_samples=100000):
+    """
+    fit a projection of the C channel location descriptors of (N, C, H, W) feature maps to dim
+    dimensions on a random sample of locations. The projection is not centred, so that the dot
+    products used by the map matching are preserved as well as possible.
+    """
+    num_images, channels = maps.shape[0], maps.shape[1]
+    locations_per_image = maps.shape[2] * maps.shape[3]
+    rng = np.random.default_rng(0)
+    images = rng.choice(num_images, size=min(num_images, max(1, num_samples // locations_per_image)), replace=False)
+    sample = np.asarray(maps[np.sort(images)], dtype='float32').transpose(0, 2, 3, 1).reshape(-1, channels)
+    _, _, vt = np.linalg.svd(sample, full_matrices=False)
+    return np.ascontiguousarray(vt[:dim], dtype='float32')
+
+
+def write_feature_maps(maps, image_names, fname, dtype='float32', pca_dim=0, components=None, block_size=256):
+    """
+    write (N, C, H, W) feature maps to HDF5 as (N, H*W, C) location descriptors, one chunk per
+    image, so that single images can be read back without loading the file.
+    dtype: storage type, float16 halves the file at the cost of precision.
+    pca_dim: if > 0, the location descriptors are projected to pca_dim dimensions first, with
+    a projection fitted on maps unless components (pca_dim, C) is given. Maps that are compared
+    with each other must share the same components.
+    Returns the components used, None without projection.
+    """
+    num_images, channels, height, width = maps.shape
+    if components is None and pca_dim > 0 and num_images > 0:
+        components = fit_location_pca(maps, pca_dim)
+    dim = channels if components is None else components.shape[0]
+    with h5py.File(fname, "w") as f:
+        dataset = f.create_dataset("maps", shape=(num_images, height * width, dim), dtype=dtype,
+                                   chunks=(1, height * width, dim))
+        for start in range(0, num_images, block_size):
+            block = np.asarray(maps[start:start + block_size], dtype='float32')
+            block = block.transpose(0, 2, 3, 1).reshape(block.shape[0], height * width, channels)
+            if components is not None:
+                block = block @ components.T
+            dataset[start:start + block.shape[0]] = block.astype(dtype)
+        f.create_dataset("image_names", data=np.array([str(name).encode("utf-8") for name in image_names]))
+        if components is not None:
+            f.create_dataset("pca_components", data=components)
+        f.attrs["height"] = height
+        f.attrs["width"] = width
+        f.attrs["channels"] = channels
+    return components
+
+
+class FeatureMaps:
+    """
+    lazy (N, H*W, C) view of a write_feature_maps file. Images are read from disk when indexed
+    and returned as float32. components: the projection the maps were written with, None if
+    they were not projected.
+    """
+
+    def __init__(self, fname):
+        self.file = h5py.File(fname, "r")
+        self.maps = self.file["maps"]
+        self.shape = self.maps.shape
+        self.ndim = len(self.shape)
+        self.height = int(self.file.attrs["height"])
+        self.width = int(self.file.attrs["width"])
+        self.components = self.file["pca_components"][:] if "pca_components" in self.file else None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return np.asarray(self.maps[index], dtype='float32')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def blocks(self, block_size):
+        for start in range(0, len(self), block_size):
+            yield start, self[start:start + block_size]
+
+
+def is_feature_map_file(fname):
+    if not str(fname).endswith(".h5") or not os.path.exists(fname):
+        return False
+    with h5py.File(fname, "r") as f:
+        return "maps" in f
+
+
+def read_feature_maps(fname):
+    """
+    image names and lazy FeatureMaps of a write_feature_maps file
+    """
+    maps = FeatureMaps(fname)
+    image_names = np.asarray([name.decode("utf-8") for name in maps.file["image_names"][:]])
+    return image_names, maps
+
+
+def shard_file(shard):
+    return f"shard_{shard:05d}.npy"
+
+
+def read_shard_manifest(save_dir):
+    """
+    read the manifest of a sharded descriptor directory, None if extraction never started
+    """
+    manifest_path = os.path.join(save_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_shard_manifest(manifest, save_dir):
+    """
+    atomically replace the manifest, so a crash never leaves a truncated one
+    """
+    manifest_path = os.path.join(save_dir, "manifest.json")
+    with open(manifest_path + ".tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+class ShardedDescriptors:
+    """
+    lazy concatenation of the shards of a sharded descriptor directory. Every shard is
+    memory-mapped and only the requested rows are copied when the view is indexed;
+    np.asarray(view) reads all of them.
+    """
+
+    def __init__(self, save_dir, num_shards):
+        self.shards = [np.load(os.path.join(save_dir, shard_file(i)), mmap_mode='r') for i in range(num_shards)]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.shape = (int(self.offsets[-1]),) + (self.shards[0].shape[1:] if num_shards > 0 else (0,))
+        self.ndim = len(self.shape)
+        self.dtype = self.shards[0].dtype if num_shards > 0 else np.dtype('float32')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self[np.array([index])][0]
+        positions = np.arange(len(self))[index]
+        out = np.empty((len(positions),) + self.shape[1:], dtype=self.dtype)
+        which = np.searchsorted(self.offsets, positions, side="right") - 1
+        for i, shard in enumerate(self.shards):
+            selected = np.nonzero(which == i)[0]
+            if len(selected) > 0:
+                out[selected] = shard[positions[selected] - self.offsets[i]]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        vectors = self[:]
+        return vectors if dtype is None else vectors.astype(dtype, copy=False)
+
+
+def read_sharded_descriptors(save_dir, mmap=True):
+    """
+    read the shards of a sharded descriptor directory as one descriptor set, a lazy
+    ShardedDescriptors view unless mmap is False, then one array in memory.
+    Raises if some shards are missing (extraction still running or interrupted).
+    """
+    manifest = read_shard_manifest(save_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"no manifest.json in {save_dir}")
+    done = {shard['shard'] for shard in manifest['shards']}
+    missing = [i for i in range(manifest['num_shards']) if i not in done]
+    if len(missing) > 0:
+        raise ValueError(f"{len(missing)} of {manifest['num_shards']} shards are not extracted yet in {save_dir}")
+    with open(os.path.join(save_dir, "image_names.json"), 'r') as f:
+        image_names = np.asarray(json.load(f))
+    vectors = ShardedDescriptors(save_dir, manifest['num_shards'])
+    if not mmap:
+        vectors = np.asarray(vectors)
+    return image_names, vectors
+
+
+def _decode_names(names):
+    return np.asarray([name.decode("utf-8") if isinstance(name, bytes) else str(name) for name in names])
+
+
+class DescriptorStore:
+    """
+    appendable HDF5 descriptor file. "vectors" (N, D) float32 and "image_names" are resizable
+    datasets grown chunk_rows at a time, "deleted" flags the rows removed by delete, which are
+    skipped by every read and dropped by compact. index maps the live names to their row.
+    Files of write_hdf5_descriptors can be read but not grown.
+    """
+
+    def __init__(self, fname, dim=None, mode="a", chunk_rows=1024):
+        self.fname = fname
+        self.file = h5py.File(fname, mode)
+        if "vectors" not in self.file:
+            if dim is None:
+                raise ValueError(f"{fname} is a new descriptor store, its dim is required")
+            self.file.create_dataset("vectors", shape=(0, dim), maxshape=(None, dim), dtype="float32",
+                                     chunks=(chunk_rows, dim))
+            self.file.create_dataset("image_names", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                                     chunks=(chunk_rows,))
+            self.file.create_dataset("deleted", shape=(0,), maxshape=(None,), dtype=bool, chunks=(chunk_rows,))
+        self.vectors = self.file["vectors"]
+        names = _decode_names(self.file["image_names"][:])
+        if "deleted" in self.file:
+            deleted = self.file["deleted"][:]
+        else:
+            deleted = np.zeros(len(names), dtype=bool)
+        self.index = {name: row for row, name in enumerate(names) if not deleted[row]}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def close(self):
+        self.file.close()
+
+    def rows(self):
+        """ live rows in file order """
+        return np.sort(np.fromiter(self.index.values(), dtype=np.int64, count=len(self.index)))
+
+    def names(self):
+        names = np.empty(self.vectors.shape[0], dtype=object)
+        for name, row in self.index.items():
+            names[row] = name
+        return names[self.rows()].astype(str)
+
+    def _check_resizable(self):
+        if "deleted" not in self.file:
+            raise ValueError(f"{self.fname} was written by write_hdf5_descriptors and cannot grow, "
+                             f"add its descriptors to a new DescriptorStore")
+
+    def add(self, vectors, image_names):
+        """
+        append vectors under image_names, names already in the store are overwritten in place
+        """
+        self._check_resizable()
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        image_names = [str(name) for name in image_names]
+        new = [i for i, name in enumerate(image_names) if name not in self.index]
+        for i, name in enumerate(image_names):
+            if name in self.index:
+                self.vectors[self.index[name]] = vectors[i]
+
+        if len(new) == 0:
+            return
+        start = self.vectors.shape[0]
+        end = start + len(new)
+        for dataset in ("vectors", "image_names", "deleted"):
+            self.file[dataset].resize(end, axis=0)
+        self.vectors[start:end] = vectors[new]
+        self.file["image_names"][start:end] = [image_names[i] for i in new]
+        self.file["deleted"][start:end] = False
+        for row, i in enumerate(new, start):
+            self.index[image_names[i]] = row
+
+    def delete(self, image_names):
+        """
+        flag the rows of image_names as deleted, their space is reclaimed by compact
+        """
+        self._check_resizable()
+        rows = np.sort([self.index.pop(str(name)) for name in image_names if str(name) in self.index])
+        if len(rows) > 0:
+            deleted = self.file["deleted"][:]
+            deleted[rows] = True
+            self.file["deleted"][:] = deleted
+
+    def get(self, image_names):
+        """
+        vectors of image_names, in that order
+        """
+        rows = np.array([self.index[str(name)] for name in image_names], dtype=np.int64)
+        return _read_rows(self.vectors, rows)
+
+    def read(self):
+        """
+        names and vectors of the live rows
+        """
+        return self.names(), _read_rows(self.vectors, self.rows())
+
+    def compact(self, block_rows=65536):
+        """
+        move the live rows to the front, in order, and shrink the datasets
+        """
+        self._check_resizable()
+        rows = self.rows()
+        names = self.names()
+        for start in range(0, len(rows), block_rows):
+            block = rows[start:start + block_rows]
+            self.vectors[start:start + len(block)] = _read_rows(self.vectors, block)
+        for dataset in ("vectors", "image_names", "deleted"):
+            self.file[dataset].resize(len(rows), axis=0)
+        self.file["image_names"][:] = list(names)
+        self.file["deleted"][:] = False
+        self.index = {name: row for row, name in enumerate(names)}
+
+
+def _read_rows(dataset, rows):
+    """
+    rows of an HDF5 dataset in the order of rows; h5py only reads increasing unique indices
+    """
+    if len(rows) == 0:
+        return np.empty((0,) + dataset.shape[1:], dtype=dataset.dtype)
+    unique, inverse = np.unique(rows, return_inverse=True)
+    if len(unique) == unique[-1] - unique[0] + 1:
+        block = dataset[unique[0]:unique[-1] + 1]
+    else:
+        block = dataset[unique]
+    return block[inverse]
+
+
+class DescriptorView:
+    """
+    lazy concatenation of the live rows of several DescriptorStore / write_hdf5_descriptors files.
+    Nothing is read until the view is indexed, then only the requested rows of each file.
+    """
+
+    def __init__(self, filenames):
+        self.stores = [DescriptorStore(fname, mode="r") for fname in filenames]
+        self.rows = [store.rows() for store in self.stores]
+        self.offsets = np.cumsum([0] + [len(rows) for rows in self.rows])
+        self.shape = (int(self.offsets[-1]), self.stores[0].dim)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def names(self):
+        return np.concatenate([store.names() for store in self.stores])
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self[np.array([index])][0]
+        positions = np.arange(len(self))[index]
+        out = np.empty((len(positions), self.shape[1]), dtype="float32")
+        which = np.searchsorted(self.offsets, positions, side="right") - 1
+        for i, store in enumerate(self.stores):
+            selected = np.nonzero(which == i)[0]
+            if len(selected) > 0:
+                out[selected] = _read_rows(store.vectors, self.rows[i][positions[selected] - self.offsets[i]])
+        return out
+
+    def close(self):
+        for store in self.stores:
+            store.close()
+
+
+def descriptor_names_file(fname):
+    """
+    names index of a .npy descriptor file: test.npy -> test_names.json
+    """
+    return os.path.splitext(fname)[0] + "_names.json"
+
+
+def write_npy_descriptors(vectors, image_names, fname):
+    """
+    write image description vectors as a raw float32 .npy block and their names to
+    descriptor_names_file(fname), so that they can be memory-mapped back.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    # write then rename, a reader never sees a half written file
+    np.save(fname + ".tmp.npy", vectors)
+    with open(descriptor_names_file(fname) + ".tmp", 'w') as f:
+        json.dump([str(name) for name in image_names], f)
+    os.replace(descriptor_names_file(fname) + ".tmp", descriptor_names_file(fname))
+    os.replace(fname + ".tmp.npy", fname)
+
+
+def read_npy_descriptors(fname, mmap=True):
+    """
+    read a write_npy_descriptors file, the vectors are memory-mapped unless mmap is False.
+    """
+    with open(descriptor_names_file(fname), 'r') as f:
+        image_names = np.asarray(json.load(f))
+    vectors = np.load(fname, mmap_mode='r' if mmap else None)
+    return image_names, vectors
+
+
+def write_descriptors(vectors, image_names, fname):
+    """
+    write image description vectors in the format given by the extension of fname:
+    .npy memory-mappable block, .h5 HDF5, anything else pickle.
+    """
+    if fname.endswith(".npy"):
+        write_npy_descriptors(vectors, image_names, fname)
+    elif fname.endswith(".h5"):
+        write_hdf5_descriptors(vectors, image_names, fname)
+    else:
+        write_pickle_descriptors(vectors, image_names, fname)
+
+
+def load_descriptors(fname, mmap=True):
+    """
+    read image description vectors of any format written by the extraction: a sharded directory,
+    a .npy block, a .h5 file (feature maps are returned as lazy FeatureMaps) or a pickle file.
+    """
+    if os.path.isdir(fname):
+        return read_sharded_descriptors(fname, mmap=mmap)
+    if fname.endswith(".npy"):
+        return read_npy_descriptors(fname, mmap=mmap)
+    if is_feature_map_file(fname):
+        return read_feature_maps(fname)
+    if fname.endswith(".h5"):
+        with DescriptorStore(fname, mode="r") as store:
+            return store.read()
+    return read_pickle_descriptors(fname)
+
+
 def generate_train_list(args):
     """generate random train triplets"""
     train_df = pd.read_csv(args.data_path + args.train_list)
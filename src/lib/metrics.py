@@ -3,10 +3,8 @@
 
 from dataclasses import astuple, dataclass
 from typing import List, Optional, Tuple
-from collections import defaultdict
 import numpy as np
 import pandas as pd
-import torch.nn.functional as F
 import torch
 from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
 import random
@@ -25,6 +23,86 @@ class PredictedMatch:
     score: float
 
 
+def intern_ids(names, vocabulary: np.ndarray) -> np.ndarray:
+    """
+    int32 index of every name in the sorted vocabulary, -1 for names it does not contain
+    """
+    names = np.asarray(names, dtype=str)
+    if len(vocabulary) == 0:
+        return np.full(len(names), -1, dtype=np.int32)
+    pos = np.minimum(np.searchsorted(vocabulary, names), len(vocabulary) - 1)
+    return np.where(vocabulary[pos] == names, pos, -1).astype(np.int32)
+
+
+@dataclass
+class GroundTruthArrays:
+    """
+    Columnar ground truth: the i-th pair is query_ids[query[i]], db_ids[db[i]].
+    query_ids and db_ids are sorted and unique.
+    """
+    query_ids: np.ndarray
+    db_ids: np.ndarray
+    query: np.ndarray
+    db: np.ndarray
+
+    def __len__(self):
+        return len(self.query)
+
+    @classmethod
+    def from_columns(cls, queries, dbs) -> "GroundTruthArrays":
+        query_ids, query = np.unique(np.asarray(queries, dtype=str), return_inverse=True)
+        db_ids, db = np.unique(np.asarray(dbs, dtype=str), return_inverse=True)
+        return cls(query_ids, db_ids, query.astype(np.int32).ravel(), db.astype(np.int32).ravel())
+
+    @classmethod
+    def from_matches(cls, gt_matches: List[GroundTruthMatch]) -> "GroundTruthArrays":
+        return cls.from_columns([g.query for g in gt_matches], [g.db for g in gt_matches])
+
+    def to_matches(self) -> List[GroundTruthMatch]:
+        return [GroundTruthMatch(q, db) for q, db in zip(self.query_ids[self.query], self.db_ids[self.db])]
+
+
+@dataclass
+class PredictionArrays:
+    """
+    Columnar predictions: the i-th prediction is query_ids[query[i]], db_ids[db[i]] with
+    float32 score[i]. query_ids and db_ids are sorted and unique. rank[i], the int32 rank of the
+    prediction within its query, is computed on first use by ranks().
+    """
+    query_ids: np.ndarray
+    db_ids: np.ndarray
+    query: np.ndarray
+    db: np.ndarray
+    score: np.ndarray
+    rank: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self.score)
+
+    @classmethod
+    def from_columns(cls, queries, dbs, scores) -> "PredictionArrays":
+        query_ids, query = np.unique(np.asarray(queries, dtype=str), return_inverse=True)
+        db_ids, db = np.unique(np.asarray(dbs, dtype=str), return_inverse=True)
+        return cls(query_ids, db_ids, query.astype(np.int32).ravel(), db.astype(np.int32).ravel(),
+                   np.asarray(scores, dtype=np.float32))
+
+    @classmethod
+    def from_matches(cls, predictions: List[PredictedMatch]) -> "PredictionArrays":
+        return cls.from_columns([p.query for p in predictions], [p.db for p in predictions],
+                                [p.score for p in predictions])
+
+    def to_matches(self) -> List[PredictedMatch]:
+        return [
+            PredictedMatch(q, db, float(score))
+            for q, db, score in zip(self.query_ids[self.query], self.db_ids[self.db], self.score)
+        ]
+
+    def ranks(self) -> np.ndarray:
+        if self.rank is None:
+            self.rank = prediction_ranks(self.query, self.score)
+        return self.rank
+
+
 @dataclass
 class Metrics:
     average_precision: float
@@ -68,7 +146,9 @@ def precision_recall(
     # eg,the final order will be (0.5, False), (0.5, False), (0.5, True), (0.4, False), ...
     # This allows to have the worst possible AP.
     # It prevents participants from putting the same score for all predictions to get a good AP.
-    order = argsort(list(zip(probas_pred, ~y_true)))
+    # lexsort is stable and sorts by its last key first, so this is the order of
+    # argsort(list(zip(probas_pred, ~y_true))) without building the tuples
+    order = np.lexsort((~y_true, probas_pred))
     order = order[::-1]  # sort by decreasing score
     probas_pred = probas_pred[order]
     y_true = y_true[order]
@@ -150,6 +230,15 @@ def check_duplicates(predictions: List[PredictedMatch]) -> List[PredictedMatch]:
         raise ValueError("Predictions contains duplicates.")
 
 
+def check_duplicates_arrays(predictions: PredictionArrays):
+    """
+    Same as check_duplicates on PredictionArrays.
+    """
+    pairs = predictions.query.astype(np.int64) * len(predictions.db_ids) + predictions.db
+    if len(np.unique(pairs)) != len(pairs):
+        raise ValueError("Predictions contains duplicates.")
+
+
 def sanitize_predictions(predictions: List[PredictedMatch]) -> List[PredictedMatch]:
     # TODO(lowik) check for other possible loopholes
     check_duplicates(predictions)
@@ -166,33 +255,104 @@ def to_arrays(gt_matches: List[GroundTruthMatch], predictions: List[PredictedMat
     return y_true, probas_pred
 
 def find_tp_ranks(gt_matches: List[GroundTruthMatch], predictions: List[PredictedMatch]):
-    q_to_res = defaultdict(list)
-    for p in predictions:
-        q_to_res[p.query].append(p)
-    ranks = []
+    """
+    rank of the prediction of every ground truth match within its query, 1 << 35 when it is
+    not predicted. Queries and references are interned to integer ids and all the ranks are
+    computed in one sort (see prediction_ranks), on the unrounded scores.
+    """
+    gt = GroundTruthArrays.from_matches(gt_matches)
+    preds = PredictionArrays.from_matches(predictions)
+    preds.rank = prediction_ranks(preds.query, np.array([p.score for p in predictions], dtype=np.float64))
+    return find_tp_ranks_arrays(gt, preds)
+
+
+def prediction_ranks(query: np.ndarray, score: np.ndarray) -> np.ndarray:
+    """
+    rank of every prediction within its query: the number of predictions of the same query
+    scoring at least as high, minus one (ties share the worst rank, as in find_tp_ranks)
+    """
+    if len(score) == 0:
+        return np.zeros(0, dtype=np.int32)
+    # dense rank of the scores, decreasing, then one integer key per (query, score)
+    _, score_rank = np.unique(-np.asarray(score, dtype=np.float64), return_inverse=True)
+    num_scores = score_rank.max() + 1
+    keys = query.astype(np.int64) * num_scores + score_rank.ravel()
+    sorted_keys = np.sort(keys)
+    group_start = np.searchsorted(sorted_keys, query.astype(np.int64) * num_scores, side="left")
+    return (np.searchsorted(sorted_keys, keys, side="right") - group_start - 1).astype(np.int32)
+
+
+def gt_prediction_index(gt: GroundTruthArrays, predictions: PredictionArrays) -> np.ndarray:
+    """
+    index in predictions of the prediction of every ground truth pair, -1 when it is not predicted
+    """
+    query = intern_ids(gt.query_ids, predictions.query_ids)[gt.query]
+    db = intern_ids(gt.db_ids, predictions.db_ids)[gt.db]
+    num_db = len(predictions.db_ids)
+    gt_pairs = np.where((query >= 0) & (db >= 0), query.astype(np.int64) * num_db + db, -1)
+    pairs = predictions.query.astype(np.int64) * num_db + predictions.db
+    if len(pairs) == 0:
+        return np.full(len(gt_pairs), -1, dtype=np.int64)
+    order = np.argsort(pairs, kind="stable")
+    sorted_pairs = pairs[order]
+    pos = np.minimum(np.searchsorted(sorted_pairs, gt_pairs), len(pairs) - 1)
+    found = (gt_pairs >= 0) & (sorted_pairs[pos] == gt_pairs)
+    return np.where(found, order[pos], -1)
+
+
+def to_arrays_columnar(gt: GroundTruthArrays, predictions: PredictionArrays):
+    """Same as to_arrays on the columnar containers"""
+    check_duplicates_arrays(predictions)
+    index = gt_prediction_index(gt, predictions)
+    y_true = np.zeros(len(predictions), dtype=bool)
+    y_true[index[index >= 0]] = True
+    return y_true, predictions.score
+
+
+def find_tp_ranks_arrays(gt: GroundTruthArrays, predictions: PredictionArrays):
+    """Same as find_tp_ranks on the columnar containers"""
     not_found = int(1<<35)
-    for m in gt_matches:
-        if m.query not in q_to_res:
-            ranks.append(not_found)
-            continue
-        res = q_to_res[m.query]
-        res = np.array([
-            (p.score, m.db == p.db)
-            for p in res
-        ])
-        i, = np.where(res[:, 1] == 1)
-        if i.size == 0:
-            ranks.append(not_found)
-        else:
-            i = i[0]
-            rank = (res[:, 0] >= res[i, 0]).sum() - 1
-            ranks.append(rank)
-    return np.array(ranks)
+    index = gt_prediction_index(gt, predictions)
+    ranks = np.full(len(gt), not_found, dtype=np.int64)
+    ranks[index >= 0] = predictions.ranks()[index[index >= 0]]
+    return ranks
+
+
+def evaluate_arrays(gt: GroundTruthArrays, predictions: PredictionArrays) -> Metrics:
+    """
+    evaluate on the columnar containers, entirely in NumPy
+    """
+    y_true, probas_pred = to_arrays_columnar(gt, predictions)
+    p, r, t = precision_recall(y_true, probas_pred, len(gt))
+    ap = average_precision(r, p)
+    pp90, rp90, tp90 = find_operating_point(p, r, t, required_x=0.9)  # @Precision=90%
+    ranks = find_tp_ranks_arrays(gt, predictions)
+    recall_at_rank1 = (ranks == 0).sum() / ranks.size
+    recall_at_rank10 = (ranks < 10).sum() / ranks.size
+
+    return Metrics(
+        average_precision=ap,
+        precisions=p,
+        recalls=r,
+        thresholds=t,
+        recall_at_p90=rp90,
+        threshold_at_p90=tp90,
+        recall_at_rank1=recall_at_rank1,
+        recall_at_rank10=recall_at_rank10,
+    )
 
 
 def evaluate(
     gt_matches: List[GroundTruthMatch], predictions: List[PredictedMatch]
 ) -> Metrics:
+    """
+    predictions: list of PredictedMatch or PredictionArrays (e.g. from io.read_prediction_arrays),
+    the latter being evaluated by evaluate_arrays
+    """
+    if isinstance(predictions, PredictionArrays):
+        if not isinstance(gt_matches, GroundTruthArrays):
+            gt_matches = GroundTruthArrays.from_matches(gt_matches)
+        return evaluate_arrays(gt_matches, predictions)
     predictions = sanitize_predictions(predictions)
     y_true, probas_pred = to_arrays(gt_matches, predictions)
     p, r, t = precision_recall(y_true, probas_pred, len(gt_matches))
@@ -232,74 +392,87 @@ def generate_5_matched_names(q_vector, db_vectors, db_names):
     return matched_names
 
 
-def confusion_matrix(data1, data2, gt, threshold, mode='euclidean'):
-    tp = 0
-    tn = 0
-    fp = 0
-    fn = 0
-    if mode == 'euclidean':
-        for item in gt:
-            l2_distances = np.squeeze(euclidean_distances(data1[item[0]].reshape(1, -1), data2))
-            if l2_distances[item[1]] <= threshold:
-                tp += 1
-                fn += 0
-            else:
-                tp += 0
-                fn += 1
-            l2_distance_n = np.delete(l2_distances, item[1])
-            tn += l2_distance_n[l2_distance_n > threshold].shape[0]
-            fp += l2_distance_n[l2_distance_n <= threshold].shape[0]
-    elif mode == 'cosine':
-        for item in gt:
-            cos_similarity = np.squeeze(cosine_similarity(data1[item[0]].reshape(1, -1), data2))
-            if cos_similarity[item[1]] >= threshold:
-                tp += 1
-                fn += 0
-            else:
-                tp += 0
-                fn += 1
-            cos_similarity_n = np.delete(cos_similarity, item[1])
-            tn += cos_similarity_n[cos_similarity_n < threshold].shape[0]
-            fp += cos_similarity_n[cos_similarity_n >= threshold].shape[0]
-    return tp, tn, fp, fn
-
-
-def calculate_top_accuracy(gt, query, database):
-    hit = 0
-    hit_cos= 0
-    miss = 0
-    miss_cos = 0
-    hit_5 = 0
-    hit_5_cos = 0
-    miss_5 = 0
-    miss_5_cos = 0
-    for pair in gt:
-        q_vector = query[pair[0]].reshape(1, -1)
-        l2_distance = np.squeeze(euclidean_distances(q_vector, database))
-        cos_similarity = np.squeeze(cosine_similarity(q_vector, database))
-        matched_index = np.argsort(l2_distance)[:5]
-        matched_cos_index = np.argsort(-cos_similarity)[:5]
-        if pair[1] in matched_index:
-            hit_5 += 1
-        else:
-            miss_5 += 1
-        if pair[1] == matched_index[0]:
-            hit += 1
-        else:
-            miss += 1
-        if pair[1] in matched_cos_index:
-            hit_5_cos += 1
-        else:
-            miss_5_cos += 1
-        if pair[1] == matched_cos_index[0]:
-            hit_cos += 1
+def pair_score_distributions(data1, data2, gt, mode='euclidean', block_size=256):
+    """
+    scores of the ground truth pairs and of every other (query, database) pair of the same
+    queries, one entry per gt item as in confusion_matrix, both sorted increasingly.
+    mode: 'euclidean' distances or 'cosine' similarities.
+    """
+    queries = np.array([item[0] for item in gt], dtype=int)
+    matches = np.array([item[1] for item in gt], dtype=int)
+    positives = np.empty(len(gt), dtype=np.float64)
+    negatives = []
+    for start in range(0, len(gt), block_size):
+        block = queries[start:start + block_size]
+        if mode == 'euclidean':
+            rows = euclidean_distances(data1[block], data2)
+        elif mode == 'cosine':
+            rows = cosine_similarity(data1[block], data2)
         else:
-            miss_cos += 1
-    # accuracy = hit / (hit + miss)
-    # accuracy_cos = hit_cos / (hit_cos + miss_cos)
-    # accuracy_5 = hit_5 / (hit_5 + miss_5)
-    # accuracy_5_cos = hit_5_cos / (hit_5_cos + miss_5_cos)
-    return hit, hit_5, hit_cos, hit_5_cos
+            raise ValueError(f"unknown mode {mode}")
+        index = np.arange(len(block))
+        positives[start:start + len(block)] = rows[index, matches[start:start + len(block)]]
+        mask = np.ones(rows.shape, dtype=bool)
+        mask[index, matches[start:start + len(block)]] = False
+        negatives.append(rows[mask])
+    negatives = np.concatenate(negatives) if len(negatives) > 0 else np.empty(0)
+    return np.sort(positives), np.sort(negatives)
+
+
+def confusion_curve(data1, data2, gt, thresholds=None, mode='euclidean'):
+    """
+    tp, tn, fp, fn of confusion_matrix for every threshold of thresholds at once: the pair scores
+    are computed and sorted once, then counted with binary searches.
+    thresholds: array of thresholds, every distinct score (the full ROC curve) if None.
+    Returns thresholds, tp, tn, fp, fn as arrays.
+    """
+    positives, negatives = pair_score_distributions(data1, data2, gt, mode)
+    if thresholds is None:
+        thresholds = np.unique(np.concatenate([positives, negatives]))
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    if mode == 'euclidean':
+        # a pair is predicted as matching when its distance is <= threshold
+        tp = np.searchsorted(positives, thresholds, side='right')
+        fp = np.searchsorted(negatives, thresholds, side='right')
+    else:
+        # a pair is predicted as matching when its similarity is >= threshold
+        tp = len(positives) - np.searchsorted(positives, thresholds, side='left')
+        fp = len(negatives) - np.searchsorted(negatives, thresholds, side='left')
+    fn = len(positives) - tp
+    tn = len(negatives) - fp
+    return thresholds, tp, tn, fp, fn
+
+
+def confusion_matrix(data1, data2, gt, threshold, mode='euclidean'):
+    _, tp, tn, fp, fn = confusion_curve(data1, data2, gt, [threshold], mode)
+    return int(tp[0]), int(tn[0]), int(fp[0]), int(fn[0])
+
+
+def top_k_hits(gt, query, database, ks=(1, 5), metric='euclidean'):
+    """
+    number of gt pairs (query index, database index) whose database item is among the k nearest
+    neighbours of the query, for every k of ks, from one blocked top-max(ks) search over the
+    distinct gt queries
+    """
+    queries, rows = np.unique(np.array([pair[0] for pair in gt], dtype=int), return_inverse=True)
+    targets = np.array([pair[1] for pair in gt], dtype=int)
+    _, indices = blocked_topk(query[queries], database, max(ks), metric=metric)
+    matched = indices[rows] == targets[:, None]
+    # rank of the target in the neighbour list, max(ks) when it is not retrieved
+    position = np.where(matched.any(axis=1), matched.argmax(axis=1), indices.shape[1])
+    return [int((position < k).sum()) for k in ks]
+
+
+def calculate_top_accuracy(gt, query, database, ks=(1, 5)):
+    """
+    top-k hits of the gt pairs with euclidean distances, then with cosine similarities, for
+    every k of ks: hit, hit_5, hit_cos, hit_5_cos with the default ks
+    """
+    if len(gt) == 0:
+        return tuple([0] * 2 * len(ks))
+    hits = top_k_hits(gt, query, database, ks, metric='euclidean')
+    hits_cos = top_k_hits(gt, query, database, ks, metric='cosine')
+    return tuple(hits + hits_cos)
 
 
 def calculate_distance(ground_truth, data1, data2):
@@ -322,14 +495,73 @@ def calculate_distance(ground_truth, data1, data2):
     return d_positive, d_negative, s_positive, s_negative
 
 
+def l2_normalize(x):
+    """
+    float32 rows scaled to unit norm, zero rows stay zero (as sklearn's cosine_similarity)
+    """
+    x = np.asarray(x, dtype='float32')
+    norms = np.sqrt(np.einsum('ij,ij->i', x, x))
+    norms[norms == 0] = 1
+    return x / norms[:, None]
+
+
+def blocked_topk(queries, database, k=1, metric='cosine', block_size=1024):
+    """
+    top-k database rows of every query row, computed block_size queries at a time so memory
+    stays bounded by block_size x len(database).
+    metric: 'cosine' (highest similarity first), 'dot' (highest inner product first) or
+    'euclidean' (smallest distance first). Similarities are float32 matrix products, euclidean
+    distances are computed as sklearn's euclidean_distances does for float32 inputs (squared
+    distances in float64, then rounded), which keeps the ranking exact for large norms.
+    Returns scores and indices of shape (nq, k), best first, ties broken by the lower index.
+    """
+    queries = np.asarray(queries, dtype='float32')
+    database = np.asarray(database, dtype='float32')
+    if metric == 'cosine':
+        queries, database = l2_normalize(queries), l2_normalize(database)
+    k = min(k, database.shape[0])
+    if metric == 'euclidean':
+        database64 = database.astype(np.float64)
+        db_norms = np.einsum('ij,ij->i', database64, database64)
+    scores = np.empty((queries.shape[0], k), dtype='float32')
+    indices = np.empty((queries.shape[0], k), dtype=np.int64)
+    for start in range(0, queries.shape[0], block_size):
+        block = queries[start:start + block_size]
+        if metric == 'euclidean':
+            block64 = block.astype(np.float64)
+            squared = -2 * (block64 @ database64.T)
+            squared += np.einsum('ij,ij->i', block64, block64)[:, None]
+            squared += db_norms
+            # negated distances, so that higher is better for every metric
+            values = -np.sqrt(np.maximum(squared.astype('float32'), 0))
+        else:
+            values = block @ database.T
+        if k == 1:
+            top = np.argmax(values, axis=1)[:, None]
+        else:
+            top = np.argpartition(-values, k - 1, axis=1)[:, :k]
+            top_values = np.take_along_axis(values, top, axis=1)
+            # argpartition keeps any of the columns tied with the k-th value, the rows where
+            # some of them were left out are selected again with a stable sort
+            kth = top_values.min(axis=1, keepdims=True)
+            partial = np.flatnonzero((values == kth).sum(axis=1) > (top_values == kth).sum(axis=1))
+            for row in partial:
+                top[row] = np.argsort(-values[row], kind='stable')[:k]
+                top_values[row] = values[row, top[row]]
+            order = np.lexsort((top, -top_values), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+        indices[start:start + block.shape[0]] = top
+        top_values = np.take_along_axis(values, top, axis=1)
+        scores[start:start + block.shape[0]] = -top_values if metric == 'euclidean' else top_values
+    return scores, indices
+
+
 def global_average_precision(ground_truth, data1, data2, dataset=None):
     if dataset == 'image collation':
-        distance_m = euclidean_distances(data1, data2)
-        similarity_m = cosine_similarity(data1, data2)
-        predictions = np.argsort(distance_m, axis=1)[:, 0]
-        confidences = np.sort(distance_m, axis=1)[:, 0]
-        predictions_s = np.argsort(-similarity_m, axis=1)[:, 0]
-        confidences_s = -np.sort(-similarity_m, axis=1)[:, 0]
+        confidences, predictions = blocked_topk(data1, data2, 1, metric='euclidean')
+        confidences_s, predictions_s = blocked_topk(data1, data2, 1, metric='cosine')
+        predictions, confidences = predictions[:, 0], confidences[:, 0]
+        predictions_s, confidences_s = predictions_s[:, 0], confidences_s[:, 0]
         correct = np.zeros(predictions.shape[0])
         correct_s = np.zeros(predictions.shape[0])
         for item in ground_truth:
@@ -352,74 +584,132 @@ def global_average_precision(ground_truth, data1, data2, dataset=None):
     return gap, gap_s
 
 
-def feature_map_matching(gt, data1, data2):
-    matched_list = []
-    confidence_list = []
+def _normalized_locations(block):
+    """
+    (n, H*W*C) flattened maps of a block of (n, C, H, W) maps or (n, H*W, C) location
+    descriptors, every location scaled to unit norm, and H*W
+    """
+    block = np.asarray(block, dtype='float32')
+    if block.ndim == 4:
+        block = block.transpose(0, 2, 3, 1).reshape(block.shape[0], -1, block.shape[1])
+    norms = np.linalg.norm(block, axis=2, keepdims=True)
+    block = block / np.maximum(norms, 1e-8)
+    return block.reshape(block.shape[0], -1), block.shape[1]
+
+
+def feature_map_matching(gt, data1, data2, block_size=64):
+    """
+    match every map of data1 to the map of data2 with the highest mean cosine similarity over
+    locations. data1, data2: (N, C, H, W) maps, (N, H*W, C) location descriptors or io.FeatureMaps.
+    With unit norm locations the mean cosine similarity is a dot product of the flattened maps
+    divided by H*W, computed block_size x block_size images at a time so the maps are streamed
+    instead of held in memory.
+    """
+    _check_same_projection(data1, data2)
     hit = 0
-    correct_list = np.zeros(data1.shape[0])
-    for vecs_1 in data1:
-        map_1 = torch.from_numpy(vecs_1)
-        map_2 = torch.from_numpy(data2)
-        map_1.cuda()
-        map_2.cuda()
-        map_1 = torch.unsqueeze(map_1, 0)
-        cos = F.cosine_similarity(map_1, map_2)
-        similarity = torch.sum(cos, axis=(1, 2)) / (map_1.shape[2] * map_1.shape[3])
-        # cos = cosine_similarity(vecs_1, vecs_2)
-        similarity = similarity.cpu().numpy()
-        matched_ind = np.argsort(-similarity)[0]
-        matched_list.append(matched_ind)
-        confidence_list.append(similarity[matched_ind])
+    correct_list = np.zeros(len(data1))
+    confidence_list = np.full(len(data1), -np.inf, dtype='float32')
+    matched_list = np.zeros(len(data1), dtype=int)
+    for start1 in range(0, len(data1), block_size):
+        block1, num_locations = _normalized_locations(data1[start1:start1 + block_size])
+        end1 = start1 + block1.shape[0]
+        for start2 in range(0, len(data2), block_size):
+            block2, _ = _normalized_locations(data2[start2:start2 + block_size])
+            similarity = block1 @ block2.T / num_locations
+            block_match = np.argmax(similarity, axis=1)
+            block_confidence = similarity[np.arange(similarity.shape[0]), block_match]
+            # strictly better only, ties keep the first match like argsort
+            better = block_confidence > confidence_list[start1:end1]
+            confidence_list[start1:end1][better] = block_confidence[better]
+            matched_list[start1:end1][better] = block_match[better] + start2
 
     for item in gt:
         if matched_list[item[0]] == item[1]:
             hit += 1
             correct_list[item[0]] = 1
     accuracy = hit / len(gt)
-    return np.array(confidence_list), np.array(correct_list), accuracy
+    return confidence_list, np.array(correct_list), accuracy
+
+
+def _location_similarity(block1, block2, sigma):
+    """
+    location matching similarity of every pair of a block of (n1, L1, C) and a block of
+    (n2, L2, C) unit norm location descriptors, as an (n1, n2) array: the best match of every
+    location of image 1, and the ranking of the locations of image 2 by the first location of
+    image 1, each weighted by how far the matched location is from its own index
+    """
+    n1, l1 = block1.shape[:2]
+    n2, l2 = block2.shape[:2]
+    cos = (block1.reshape(n1 * l1, -1) @ block2.reshape(n2 * l2, -1).T).reshape(n1, l1, n2, l2)
+
+    predict_12 = np.argmax(cos, axis=3)
+    confidence_12 = np.max(cos, axis=3)
+    diff_12 = np.abs(np.arange(l1)[None, :, None] - predict_12)
+    similarity_12 = np.sum(np.exp(-np.square(diff_12) / 2 * sigma) * confidence_12, axis=1) / (2 * l1)
+
+    first = cos[:, 0]
+    predict_21 = np.argsort(-first, axis=2)
+    confidence_21 = np.take_along_axis(first, predict_21, axis=2)
+    diff_21 = np.abs(np.arange(l2) - predict_21)
+    similarity_21 = np.sum(np.exp(-np.square(diff_21) / 2 * sigma) * confidence_21, axis=2) / (2 * l2)
+    return similarity_12 + similarity_21
+
+
+def _unit_locations(block):
+    flat, num_locations = _normalized_locations(block)
+    return flat.reshape(flat.shape[0], num_locations, -1)
+
+
+def _check_same_projection(data1, data2):
+    """
+    feature maps written with different projections (see io.write_feature_maps) live in
+    different bases, their similarities are meaningless
+    """
+    components1 = getattr(data1, 'components', None)
+    components2 = getattr(data2, 'components', None)
+    if components1 is None and components2 is None:
+        return
+    if components1 is None or components2 is None or not np.array_equal(components1, components2):
+        raise ValueError("the feature maps were projected with different PCA components, "
+                         "write them with the same components to compare them")
 
 
-def feature_location_matching(gt, map1_f, map2_f, sigma):
-    matched_list = []
-    confidence_list = []
+def feature_location_matching(gt, map1_f, map2_f, sigma, block_size=16):
+    """
+    match every image of map1_f to the image of map2_f with the highest location matching
+    similarity (see _location_similarity). map1_f, map2_f: (N, L, C) location descriptors or
+    io.FeatureMaps, read block_size images at a time: map2_f is streamed once per block of map1_f.
+    """
+    _check_same_projection(map1_f, map2_f)
     hit = 0
-    similarity_list = []
-    correct_list = np.zeros(map1_f.shape[0])
-    for vec1s in map1_f:
-        for vec2s in map2_f:
-            cos = cosine_similarity(vec1s, vec2s)
-            predict_vec_12 = np.argsort(-cos, axis=1)[:, 0]
-            confidence_vec_12 = -np.sort(-cos, axis=1)[:, 0]
-            locations_12 = np.linspace(0, predict_vec_12.shape[0] - 1, predict_vec_12.shape[0], dtype=int)
-            diff_location_12 = np.abs(locations_12 - predict_vec_12)
-            weights_12 = np.exp(-np.square(diff_location_12) / 2 * sigma)
-            similarity_12 = np.sum(weights_12 * confidence_vec_12) / (2 * predict_vec_12.shape[0])
-
-            predict_vec_21 = np.argsort(-cos, axis=1)[0, :]
-            confidence_vec_21 = -np.sort(-cos, axis=1)[0, :]
-            locations_21 = np.linspace(0, predict_vec_21.shape[0] - 1, predict_vec_21.shape[0], dtype=int)
-            diff_location_21 = np.abs(locations_21 - predict_vec_21)
-            weights_21 = np.exp(-np.square(diff_location_21) / 2 * sigma)
-            similarity_21 = np.sum(weights_21 * confidence_vec_21) / (2 * predict_vec_21.shape[0])
-            similarity_list.append(similarity_12 + similarity_21)
-        similarity_array = np.asarray(similarity_list)
-        matched_list.append(np.argsort(-similarity_array)[0])
-        confidence_list.append(-np.sort(-similarity_array)[0])
-        similarity_list.clear()
-
-        for item in gt:
-            if matched_list[item[0]] == item[1]:
-                hit += 1
-                correct_list[item[0]] = 1
-        accuracy = hit / len(gt)
-        return np.array(confidence_list), np.array(correct_list), accuracy
+    correct_list = np.zeros(len(map1_f))
+    confidence_list = np.full(len(map1_f), -np.inf)
+    matched_list = np.zeros(len(map1_f), dtype=int)
+    for start1 in range(0, len(map1_f), block_size):
+        block1 = _unit_locations(map1_f[start1:start1 + block_size])
+        end1 = start1 + block1.shape[0]
+        for start2 in range(0, len(map2_f), block_size):
+            similarity = _location_similarity(block1, _unit_locations(map2_f[start2:start2 + block_size]), sigma)
+            block_match = np.argmax(similarity, axis=1)
+            block_confidence = similarity[np.arange(similarity.shape[0]), block_match]
+            # strictly better only, ties keep the first match
+            better = block_confidence > confidence_list[start1:end1]
+            confidence_list[start1:end1][better] = block_confidence[better]
+            matched_list[start1:end1][better] = block_match[better] + start2
+
+    for item in gt:
+        if matched_list[item[0]] == item[1]:
+            hit += 1
+            correct_list[item[0]] = 1
+    accuracy = hit / len(gt)
+    return confidence_list, correct_list, accuracy
+
 
 def feature_vector_matching(gt, data1, data2):
     hit = 0
     correct_list = np.zeros(data1.shape[0])
-    similarity = cosine_similarity(data1, data2)
-    predictions = np.argsort(-similarity, axis=1)[:, 0]
-    confidences = -np.sort(-similarity, axis=1)[:, 0]
+    confidences, predictions = blocked_topk(data1, data2, 1, metric='cosine')
+    confidences, predictions = confidences[:, 0], predictions[:, 0]
     for item in gt:
         if predictions[item[0]] == item[1]:
             hit += 1
@@ -431,13 +721,11 @@ def feature_vector_matching(gt, data1, data2):
 def feature_vector_matching_mix(gt, data1_1, data2_1, data1_2, data2_2, data1_3, data2_3, data1_4, data2_4):
     hit = 0
     correct_list = np.zeros(data1_1.shape[0])
-    similarity1 = cosine_similarity(data1_1, data2_1)
-    similarity2 = cosine_similarity(data1_2, data2_2)
-    similarity3 = cosine_similarity(data1_3, data2_3)
-    similarity4 = cosine_similarity(data1_4, data2_4)
-    similarity = similarity1 + similarity2 + similarity3 + similarity4
-    predictions = np.argsort(-similarity, axis=1)[:, 0]
-    confidences = -np.sort(-similarity, axis=1)[:, 0]
+    # the sum of the four cosine similarities is the inner product of the concatenated normalized vectors
+    mix1 = np.hstack([l2_normalize(data1_1), l2_normalize(data1_2), l2_normalize(data1_3), l2_normalize(data1_4)])
+    mix2 = np.hstack([l2_normalize(data2_1), l2_normalize(data2_2), l2_normalize(data2_3), l2_normalize(data2_4)])
+    confidences, predictions = blocked_topk(mix1, mix2, 1, metric='dot')
+    confidences, predictions = confidences[:, 0], predictions[:, 0]
     for item in gt:
         if predictions[item[0]] == item[1]:
             hit += 1
@@ -455,33 +743,43 @@ def calculate_gap(confidence, correct, gt):
     return gap
 
 
+RANKED_NUM_CLASSES = {'artdl': 17, 'photoart50': 50}
+
+
+def ranked_metrics(gt_array, vectors, recall_ranks=(5, 20, 50), map_ranks=(10, 20, 50), num_classes=None):
+    """
+    ranked_recall for every rank of recall_ranks and ranked_mean_precision for every rank of
+    map_ranks from one blocked cosine top-K search of the vectors against themselves, K being
+    the largest rank needed, and the cumulative count of same-label neighbours along it.
+    Returns the list of recalls and the list of mean precisions.
+    """
+    if torch.is_tensor(vectors):
+        vectors = vectors.detach().cpu().numpy()
+    gt_array = np.asarray(gt_array)
+    n = gt_array.shape[0]
+    max_rank = max(list(recall_ranks) + [rank + 1 for rank in map_ranks])
+    _, indices = blocked_topk(vectors, vectors, max_rank, metric='cosine')
+    # same_label[i, r]: number of vectors with the label of i among its r + 1 nearest, itself included
+    same_label = np.cumsum(gt_array[indices] == gt_array[:, None], axis=1)
+    _, inverse, counts = np.unique(gt_array, return_inverse=True, return_counts=True)
+    class_num = counts[inverse]
+
+    recalls = []
+    for rank in recall_ranks:
+        tp = same_label[:, min(rank, n) - 1] - 1
+        recalls.append(float(np.sum(np.sqrt(class_num / (class_num + 1)) * (tp / class_num))))
+    maps = []
+    for rank in map_ranks:
+        tp = same_label[:, min(rank + 1, n) - 1] - 1
+        precisions = np.bincount(gt_array, weights=(tp / rank) / class_num, minlength=num_classes or 0)
+        maps.append(float(np.mean(precisions)))
+    return recalls, maps
+
+
 def ranked_recall(gt_array, vectors, rank):
-    recall = 0
-    for i in range(gt_array.shape[0]):
-        label = gt_array[i]
-        class_num = gt_array[gt_array == label].shape[0]
-        weight = np.sqrt(class_num / (class_num + 1))
-        cos = F.cosine_similarity(vectors[i], vectors, dim=-1).cpu().numpy()
-        label_match = gt_array[np.argsort(-cos)]
-        label_predict = list(label_match[:rank])
-        tp = label_predict.count(label) - 1
-        recall += weight * (tp / class_num)
-    return recall
+    return ranked_metrics(gt_array, vectors, recall_ranks=[rank], map_ranks=[])[0][0]
 
 
 def ranked_mean_precision(args, gt_array, vectors, rank):
-    if args.test_dataset == 'artdl':
-        precisions = np.zeros(17)
-    elif args.test_dataset == "photoart50":
-        precisions = np.zeros(50)
-    for i in range(gt_array.shape[0]):
-        label = gt_array[i]
-        class_num = gt_array[gt_array == label].shape[0]
-        cos = F.cosine_similarity(vectors[i], vectors, dim=-1).cpu().numpy()
-        label_match = gt_array[np.argsort(-cos)]
-        label_predict = list(label_match[:rank+1])
-        tp = label_predict.count(label) - 1
-        fp = rank - tp
-        precisions[label] += (tp/(tp+fp))/class_num
-    map = np.mean(precisions)
-    return map
\ No newline at end of file
+    return ranked_metrics(gt_array, vectors, recall_ranks=[], map_ranks=[rank],
+                          num_classes=RANKED_NUM_CLASSES[args.test_dataset])[1][0]
@@ -25,6 +25,14 @@ def siamese_args():
     aa('--optimizer', default="sgd", help='type of optimizer')
     aa('--loss', default="normal", help='type of loss strcture')
     aa('--method', default=None, help='type of experiment method')
+    aa('--methods', default=None, help="comma separated poolings computed from one backbone pass, each written to test_f with _<method> appended")
+    aa('--map_dtype', default='float32', help="storage type of feature maps written to .h5 files, float16 halves them at the cost of precision")
+    aa('--map_pca_dim', default=0, type=int, help="project the feature map locations written to .h5 files to this dimension, 0 to keep them")
+    aa('--shard_size', default=0, type=int, help="write descriptors in resumable shards of this many images, 0 for one file")
+    aa('--append_store', default=False, action="store_true", help="only embed the images missing from the .h5 descriptor store test_f and append them")
+    aa('--num_procs', default=0, type=int, help="embed on cpu with this many processes, 0 or 1 for a single one")
+    aa('--threads_per_proc', default=0, type=int, help="torch threads of each --num_procs process, 0 to split the cores evenly")
+    aa('--report_scaling', default=0, type=int, help="time cpu extraction of this many images from 1 process up to the core count, 0 to skip")
 
     group = parser.add_argument_group('model options')
     aa('--model', default=EXP_PARAMS['model']['model_name'], help="model to use")
@@ -49,6 +57,7 @@ def siamese_args():
     aa('--test_dataset', default=EXP_PARAMS['dataset']['dataset_name'], help="test dataset name")
     aa('--data_path', default=EXP_PARAMS['dataset']['data_path'], help="Path to dataset folder")
     aa('--database_path', default=EXP_PARAMS['dataset']['database_path'], help="Path to images folder")
+    aa('--image_store', default=None, help="folder written by 12_create_image_store.py, read instead of decoding the images")
     aa('--d1', default='/cluster/shared_dataset/ImageCollation/ManuscriptDownloader/download/D1/', help="folder for d1 subset")
     aa('--d2', default='/cluster/shared_dataset/ImageCollation/ManuscriptDownloader/download/D2/', help="folder for d2 subset")
     aa('--d3', default='/cluster/shared_dataset/ImageCollation/ManuscriptDownloader/download/D3/', help="folder for d3 subset")
@@ -75,6 +84,9 @@ def siamese_args():
     aa('--full_f', default="isc2021/data/full_siamese.hdf5", help="write full features to this file")
     aa('--matched_f', default=None, help="save matched result to this folder")
     aa('--test_f', default=None, help="save test result to this folder")
+    aa('--cache_dir', default=None, help="reuse descriptors of unchanged images from this cache folder")
+    aa('--cache_max_gb', default=None, type=float, help="evict least recently used cached descriptors above this size")
+    aa('--cache_max_days', default=None, type=float, help="evict cached descriptors unused for this many days")
     aa('--net', default=EXP_PATH + 'models/', help="save network parameters to this folder")
     aa('--plots', default=EXP_PATH + 'plots/', help="save visualized test result to this folder")
     aa('--save_model', default='best.pth', help="name of the saved cehckpoint")
@@ -92,6 +104,18 @@ def siamese_args():
 
     args = parser.parse_args()
     args.scales = [float(x) for x in args.scales.split(",")]
+    if args.methods is not None and args.loss == "custom":
+        parser.error("--methods is only supported with --loss normal, "
+                     "TripletSiameseNetwork_custom does not implement forward_pooled")
+    output_modes = [flag for flag, on in [('--methods', args.methods is not None), ('--append_store', args.append_store),
+                                          ('--shard_size', args.shard_size > 0)] if on]
+    if len(output_modes) > 1:
+        parser.error(f"{' and '.join(output_modes)} select different outputs, use only one of them")
+    if len(output_modes) > 0 and args.cache_dir is not None:
+        parser.error(f"--cache_dir is not supported with {output_modes[0]}")
+    if len(output_modes) > 0 and args.test_dataset == "image_collation":
+        parser.error(f"{output_modes[0]} is not supported for image_collation, its splits are written "
+                     f"to p1_f ... d3_f")
 
     print("args=", args)
 
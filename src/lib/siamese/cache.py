@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    sha1 of the content of a file
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def setup_hash(args, transforms):
+    """
+    hash of everything besides the image that determines a descriptor: checkpoint file content,
+    model, method, loss and the get_transforms pipeline
+    """
+    checkpoint = None
+    if args.net and os.path.exists(args.net + args.checkpoint):
+        checkpoint = file_hash(args.net + args.checkpoint)
+    setup = {
+        'checkpoint': checkpoint,
+        'model': args.model,
+        'method': args.method,
+        'loss': args.loss,
+        'transforms': repr(transforms),
+    }
+    return hashlib.sha1(json.dumps(setup, sort_keys=True).encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed on-disk cache of image descriptors.
+    Entries live in root/<setup hash>/<image hash>.npy, so a descriptor is reused only for an
+    unchanged image file embedded with the same checkpoint, model, method, loss and transforms.
+    Every hit refreshes the entry modification time, evict() then removes entries older than
+    max_age_days and the least recently used ones above max_gb, across all setups.
+    """
+
+    def __init__(self, root, args, transforms, max_gb=None, max_age_days=None):
+        self.root = root
+        self.setup = setup_hash(args, transforms)
+        self.path = os.path.join(root, self.setup)
+        self.max_bytes = None if max_gb is None else max_gb * 1024 ** 3
+        self.max_age = None if max_age_days is None else max_age_days * 24 * 3600
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def image_key(self, image_path):
+        return file_hash(image_path)
+
+    def get(self, key):
+        entry = self._entry(key)
+        try:
+            vector = np.load(entry)
+        except (OSError, ValueError):
+            return None
+        os.utime(entry)
+        return vector
+
+    def put(self, key, vector):
+        entry = self._entry(key)
+        np.save(entry + '.tmp.npy', np.ascontiguousarray(vector, dtype='float32'))
+        os.replace(entry + '.tmp.npy', entry)
+
+    def evict(self):
+        entries = []
+        for setup in os.listdir(self.root):
+            setup_path = os.path.join(self.root, setup)
+            if not os.path.isdir(setup_path):
+                continue
+            for name in os.listdir(setup_path):
+                path = os.path.join(setup_path, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            too_old = self.max_age is not None and now - mtime > self.max_age
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            if not too_old and not too_big:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        if removed > 0:
+            print(f"evicted {removed} cached descriptors, cache size {total / 1024 ** 2:.1f} MB")
+
+
+def open_cache(args, transforms):
+    """
+    EmbeddingCache configured by --cache_dir, --cache_max_gb and --cache_max_days, None without --cache_dir
+    """
+    if args.cache_dir is None:
+        return None
+    return EmbeddingCache(args.cache_dir, args, transforms, max_gb=args.cache_max_gb,
+                          max_age_days=args.cache_max_days)
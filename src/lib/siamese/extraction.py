@@ -0,0 +1,403 @@
+import os
+import copy
+import json
+import time
+import tempfile
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset, ConcatDataset
+
+from .model import TripletSiameseNetwork, TripletSiameseNetwork_custom
+from ..io import write_descriptors, write_feature_maps, DescriptorStore, shard_file, read_shard_manifest, write_shard_manifest
+
+
+def load_network(args):
+    """
+    build the siamese network of args, load the trained weights of args.net + args.checkpoint
+    when present and move it to args.device in eval mode
+    """
+    if args.loss == "custom":
+        print('model trained with custom loss')
+        net = TripletSiameseNetwork_custom(args.model)
+    elif args.loss == "normal":
+        print('model trained with regular loss')
+        net = TripletSiameseNetwork(args.model, args.method)
+
+    try:
+        state_dict = torch.load(args.net + args.checkpoint, map_location='cpu')
+        net.load_state_dict(state_dict)
+        print('load trained model:{}'.format(args.net + args.checkpoint))
+    except:
+        pass
+
+    net.eval()
+    net.to(args.device)
+    return net
+
+
+def save_descriptors(args, features, image_names, save_path, components=None):
+    """
+    feature maps (N, C, H, W) go to a chunked HDF5 file when save_path ends with .h5,
+    stored as args.map_dtype and optionally reduced to args.map_pca_dim with components, or
+    with a projection fitted on features (see io.write_feature_maps), everything else to the
+    format of the extension of save_path (see io.write_descriptors).
+    Returns the feature map projection, None if there is none.
+    """
+    if save_path.endswith('.h5') and features.ndim == 4:
+        return write_feature_maps(features, image_names, save_path, dtype=args.map_dtype,
+                                  pca_dim=args.map_pca_dim, components=components)
+    write_descriptors(features, image_names, save_path)
+    return None
+
+
+def select_descriptor(args, outputs):
+    """
+    pick the retrieval descriptor among the outputs of net.forward_once
+    """
+    if args.loss == "custom":
+        if args.model == 'resnet50':
+            # GeM pooled layer3
+            return outputs[2]
+        # normalized fc7 for vgg / vgg_fc7
+        return outputs[-1]
+    return outputs
+
+
+def embed_batch(args, net, images):
+    """
+    descriptors of a batch of images as a numpy array, to be called under torch.no_grad()
+    """
+    return select_descriptor(args, net.forward_once(images.to(args.device))).cpu().numpy()
+
+
+def generate_features(args, net, data_loader, image_names=None, save_path=None, out=None, cache=None):
+    """
+    embed every image of data_loader with net, batch by batch, into one float32 array.
+    out: optional preallocated array (or np.memmap) of shape (len(dataset), ...),
+    allocated after the first batch otherwise.
+    cache: optional EmbeddingCache, only the images missing from it are embedded.
+    The descriptors are written with image_names to save_path if given, and returned.
+    """
+    if cache is not None:
+        features = generate_cached_features(args, net, data_loader, cache, out=out)
+        if save_path is not None:
+            save_descriptors(args, features, image_names, save_path)
+            print(f"writing descriptors to {save_path}")
+        return features
+
+    features = out
+    start = 0
+    t0 = time.time()
+    with torch.no_grad():
+        for images in data_loader:
+            feats = embed_batch(args, net, images)
+            if features is None:
+                features = np.empty((len(data_loader.dataset),) + feats.shape[1:], dtype='float32')
+            features[start:start + feats.shape[0]] = feats
+            start += feats.shape[0]
+    t1 = time.time()
+    print(f"image_description_time: {(t1 - t0) / max(start, 1):.5f} s per image, "
+          f"{start / max(t1 - t0, 1e-9):.1f} images per second")
+
+    if save_path is not None:
+        save_descriptors(args, features, image_names, save_path)
+        print(f"writing descriptors to {save_path}")
+    return features
+
+
+def generate_sharded_features(args, net, dataset, image_names, save_dir, shard_size):
+    """
+    resumable extraction: the images of dataset are embedded shard_size at a time and each
+    shard is written to save_dir as soon as it is complete. manifest.json records the image
+    range of every finished shard, so a restarted extraction of the same image list skips them.
+    Read the result with io.read_sharded_descriptors.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    image_names = [str(name) for name in image_names]
+    num_images = len(dataset)
+    num_shards = (num_images + shard_size - 1) // shard_size
+
+    manifest = read_shard_manifest(save_dir)
+    if manifest is None:
+        with open(os.path.join(save_dir, "image_names.json"), 'w') as f:
+            json.dump(image_names, f)
+        manifest = {'num_images': num_images, 'shard_size': shard_size, 'num_shards': num_shards, 'shards': []}
+        write_shard_manifest(manifest, save_dir)
+    elif manifest['num_images'] != num_images or manifest['shard_size'] != shard_size:
+        raise ValueError(f"{save_dir} holds a different extraction: {manifest['num_images']} images "
+                         f"in shards of {manifest['shard_size']}")
+    else:
+        with open(os.path.join(save_dir, "image_names.json"), 'r') as f:
+            if json.load(f) != image_names:
+                raise ValueError(f"{save_dir} holds the extraction of a different image list, "
+                                 f"remove it or choose another directory")
+
+    done = {shard['shard'] for shard in manifest['shards']}
+    print(f"{len(done)} of {num_shards} shards already extracted in {save_dir}")
+    for shard in range(num_shards):
+        if shard in done and os.path.exists(os.path.join(save_dir, shard_file(shard))):
+            continue
+        start, end = shard * shard_size, min((shard + 1) * shard_size, num_images)
+        loader = DataLoader(dataset=Subset(dataset, range(start, end)), shuffle=False,
+                            num_workers=args.num_workers, batch_size=args.batch_size)
+        features = generate_features(args, net, loader)
+
+        # write then rename, a shard file is either complete or absent
+        path = os.path.join(save_dir, shard_file(shard))
+        np.save(path + ".tmp.npy", features)
+        os.replace(path + ".tmp.npy", path)
+        manifest['shards'] = [s for s in manifest['shards'] if s['shard'] != shard]
+        manifest['shards'].append({'shard': shard, 'start': start, 'end': end})
+        write_shard_manifest(manifest, save_dir)
+        print(f"shard {shard + 1}/{num_shards} (images {start}-{end}) written to {path}")
+
+
+def generate_store_features(args, net, dataset, image_names, save_path):
+    """
+    incremental extraction into the appendable io.DescriptorStore save_path: only the images
+    whose name is not in the store yet are embedded, then appended to it
+    """
+    image_names = [str(name) for name in image_names]
+    store = DescriptorStore(save_path) if os.path.exists(save_path) else None
+    missing = [i for i, name in enumerate(image_names) if store is None or name not in store]
+    print(f"{len(image_names) - len(missing)} of {len(image_names)} images already in {save_path}")
+    if len(missing) > 0:
+        loader = DataLoader(dataset=Subset(dataset, missing), shuffle=False, num_workers=args.num_workers,
+                            batch_size=args.batch_size)
+        features = generate_features(args, net, loader)
+        if store is None:
+            store = DescriptorStore(save_path, dim=features.shape[1])
+        store.add(features, [image_names[i] for i in missing])
+        print(f"{len(missing)} descriptors added, {len(store)} in {save_path}")
+    if store is not None:
+        store.close()
+
+
+def dataset_image_list(dataset):
+    """
+    image paths of an ImageList, or of the concatenation of several
+    """
+    if isinstance(dataset, ConcatDataset):
+        return [path for d in dataset.datasets for path in dataset_image_list(d)]
+    return list(dataset.image_list)
+
+
+def generate_cached_features(args, net, data_loader, cache, out=None):
+    """
+    look every image of data_loader.dataset up in cache by file content, embed the missing
+    ones only and store them in cache
+    """
+    dataset = data_loader.dataset
+    keys = [cache.image_key(path) for path in dataset_image_list(dataset)]
+    features = out
+    missing = []
+    for i, key in enumerate(keys):
+        vector = cache.get(key)
+        if vector is None:
+            missing.append(i)
+            continue
+        if features is None:
+            features = np.empty((len(keys),) + vector.shape, dtype='float32')
+        features[i] = vector
+    print(f"{len(keys) - len(missing)} of {len(keys)} descriptors found in cache {cache.path}")
+
+    if len(missing) > 0:
+        if getattr(args, 'num_procs', 0) > 1:
+            new_features = generate_parallel_features(args, Subset(dataset, missing))
+        else:
+            loader = DataLoader(dataset=Subset(dataset, missing), shuffle=False,
+                                num_workers=data_loader.num_workers, batch_size=data_loader.batch_size)
+            new_features = generate_features(args, net, loader)
+        if features is None:
+            features = np.empty((len(keys),) + new_features.shape[1:], dtype='float32')
+        features[missing] = new_features
+        for i, vector in zip(missing, new_features):
+            cache.put(keys[i], vector)
+    cache.evict()
+    return features
+
+
+def _write_split(args, features, i, image_names, save_paths, components):
+    """
+    write split i to save_paths[i] if given and release it (None), return it otherwise.
+    Feature maps are projected with components, the projection fitted on the first written split
+    when None. Returns the split (or None) and the projection for the next splits.
+    """
+    if save_paths is None or save_paths[i] is None:
+        return features, components
+    components = save_descriptors(args, features, image_names[i], save_paths[i], components=components)
+    print(f"writing descriptors to {save_paths[i]}")
+    return None, components
+
+
+def generate_split_features(args, net, datasets, image_names=None, save_paths=None, cache=None):
+    """
+    embed several splits (e.g. p1..p3, d1..d3) through a single DataLoader over their
+    concatenation, so the workers keep decoding across split boundaries instead of draining
+    one loader per split. Every split has its own array, written to save_paths[i] with
+    image_names[i] as soon as its last image is embedded and then released, so a single split
+    is held in memory at a time. With args.map_pca_dim, the feature map projection is fitted on
+    the first written split and reused for the others, so that the splits stay comparable.
+    Returns the list of split descriptors, None for written splits.
+    With a cache or args.num_procs > 1 the splits go one by one through generate_features /
+    generate_parallel_features instead.
+    """
+    split_features = []
+    components = None
+    if cache is not None or getattr(args, 'num_procs', 0) > 1:
+        for i, dataset in enumerate(datasets):
+            if cache is None:
+                features = generate_parallel_features(args, dataset)
+            else:
+                loader = DataLoader(dataset=dataset, shuffle=False, num_workers=args.num_workers,
+                                    batch_size=args.batch_size)
+                features = generate_features(args, net, loader, cache=cache)
+            features, components = _write_split(args, features, i, image_names, save_paths, components)
+            split_features.append(features)
+        return split_features
+
+    loader = iter(DataLoader(dataset=ConcatDataset(datasets), shuffle=False, num_workers=args.num_workers,
+                             batch_size=args.batch_size))
+    # rows of the last batch not assigned to a split yet, a batch can span a split boundary
+    pending = np.empty((0,), dtype='float32')
+    t0 = time.time()
+    with torch.no_grad():
+        for i, dataset in enumerate(datasets):
+            features = None
+            filled = 0
+            while filled < len(dataset):
+                if len(pending) == 0:
+                    pending = embed_batch(args, net, next(loader))
+                if features is None:
+                    features = np.empty((len(dataset),) + pending.shape[1:], dtype='float32')
+                take = min(len(pending), len(dataset) - filled)
+                features[filled:filled + take] = pending[:take]
+                pending = pending[take:]
+                filled += take
+            if features is None:
+                features = np.empty((0,) + pending.shape[1:], dtype='float32')
+            features, components = _write_split(args, features, i, image_names, save_paths, components)
+            split_features.append(features)
+    num_images = sum(len(dataset) for dataset in datasets)
+    t1 = time.time()
+    print(f"image_description_time: {(t1 - t0) / max(num_images, 1):.5f} s per image, "
+          f"{num_images / max(t1 - t0, 1e-9):.1f} images per second")
+    return split_features
+
+
+def _parallel_worker(rank, args, dataset, bounds, part_dir, threads):
+    """
+    one process of generate_parallel_features: embed the image range bounds[rank] of dataset
+    with its own copy of the network and threads intra-op threads
+    """
+    torch.set_num_threads(threads)
+    net = load_network(args)
+    start, end = bounds[rank]
+    # decoding runs inline, the process stays within its thread budget
+    loader = DataLoader(dataset=Subset(dataset, range(start, end)), shuffle=False, num_workers=0,
+                        batch_size=args.batch_size)
+    features = generate_features(args, net, loader)
+    np.save(os.path.join(part_dir, f"part_{rank:03d}.npy"), features)
+
+
+def generate_parallel_features(args, dataset, image_names=None, save_path=None, num_procs=None,
+                               threads_per_proc=None, out=None):
+    """
+    CPU data parallel extraction: dataset is cut into num_procs contiguous image ranges, each
+    embedded by a separate process that loads the network once and runs threads_per_proc
+    intra-op threads (os.cpu_count() // num_procs by default). The parts are copied back in
+    image order, one memory-mapped part at a time, into out (optional preallocated array or
+    np.memmap of shape (len(dataset), ...), allocated once otherwise), written with image_names
+    to save_path if given, and returned.
+    """
+    if len(dataset) == 0:
+        raise ValueError("generate_parallel_features got an empty dataset, there is nothing to embed")
+    num_procs = min(num_procs or args.num_procs, len(dataset))
+    threads = threads_per_proc or getattr(args, 'threads_per_proc', 0) or max(1, os.cpu_count() // num_procs)
+    worker_args = copy.copy(args)
+    worker_args.device = 'cpu'
+    edges = np.linspace(0, len(dataset), num_procs + 1).astype(int)
+    bounds = [(int(edges[i]), int(edges[i + 1])) for i in range(num_procs)]
+
+    t0 = time.time()
+    features = out
+    with tempfile.TemporaryDirectory() as part_dir:
+        mp.spawn(_parallel_worker, args=(worker_args, dataset, bounds, part_dir, threads), nprocs=num_procs)
+        for rank, (start, end) in enumerate(bounds):
+            part = np.load(os.path.join(part_dir, f"part_{rank:03d}.npy"), mmap_mode='r')
+            if features is None:
+                features = np.empty((len(dataset),) + part.shape[1:], dtype='float32')
+            features[start:end] = part
+            del part
+    t1 = time.time()
+    print(f"{num_procs} processes x {threads} threads: {len(dataset) / max(t1 - t0, 1e-9):.1f} images per second "
+          f"including model loading")
+
+    if save_path is not None:
+        save_descriptors(args, features, image_names, save_path)
+        print(f"writing descriptors to {save_path}")
+    return features
+
+
+def report_parallel_scaling(args, dataset, num_images):
+    """
+    time generate_parallel_features on the first num_images of dataset with 1, 2, 4, ... processes
+    up to the core count, the cores being split evenly between the processes, and print the
+    throughput and speedup over a single process
+    """
+    cores = os.cpu_count()
+    subset = Subset(dataset, range(min(num_images, len(dataset))))
+    counts = []
+    n = 1
+    while n < cores:
+        counts.append(n)
+        n *= 2
+    counts.append(cores)
+
+    print(f"cpu scaling on {len(subset)} images, {cores} cores")
+    baseline = None
+    for n in counts:
+        t0 = time.time()
+        generate_parallel_features(args, subset, num_procs=n, threads_per_proc=max(1, cores // n))
+        throughput = len(subset) / max(time.time() - t0, 1e-9)
+        baseline = baseline or throughput
+        print(f"procs: {n:3d}  threads/proc: {max(1, cores // n):3d}  images/s: {throughput:8.1f}  "
+              f"speedup: {throughput / baseline:.2f}")
+
+
+def pooled_path(save_path, method):
+    """
+    descriptor file of one pooling method: artdl_test.pkl -> artdl_test_gem.pkl
+    """
+    stem, ext = os.path.splitext(save_path)
+    return f"{stem}_{method}{ext}"
+
+
+def generate_multi_pool_features(args, net, data_loader, methods, image_names=None, save_path=None):
+    """
+    embed data_loader once through net.head and pool the feature maps with every method of
+    methods (see TripletSiameseNetwork.pool). Returns a dict method -> float32 array, each written
+    with image_names to pooled_path(save_path, method) if save_path is given.
+    """
+    features = {}
+    start = 0
+    t0 = time.time()
+    with torch.no_grad():
+        for images in data_loader:
+            images = images.to(args.device)
+            pooled = net.forward_pooled(images, methods)
+            for method in methods:
+                feats = pooled[method].cpu().numpy()
+                if method not in features:
+                    features[method] = np.empty((len(data_loader.dataset),) + feats.shape[1:], dtype='float32')
+                features[method][start:start + feats.shape[0]] = feats
+            start += images.shape[0]
+    t1 = time.time()
+    print(f"image_description_time: {(t1 - t0) / max(start, 1):.5f} s per image for {len(methods)} poolings")
+
+    if save_path is not None:
+        for method in methods:
+            save_descriptors(args, features[method], image_names, pooled_path(save_path, method))
+            print(f"writing {method} descriptors to {pooled_path(save_path, method)}")
+    return features
@@ -268,26 +268,34 @@ class TripletSiameseNetwork(nn.Module):
         x = F.adaptive_avg_pool2d(x, (1, 1))
         return x ** (1. / p)
 
-    def forward_once(self, x):
-        x = self.head(x)
-        if self.method == 'center_extraction' or self.method == 'warp_extraction':
+    def pool(self, x, method):
+        if method == 'center_extraction' or method == 'warp_extraction':
             x = F.normalize(x)
-        elif self.method == 'max_pool':
+        elif method == 'max_pool':
             x = F.adaptive_max_pool2d(x, (1, 1))
             x = self.flatten(x)
-        elif self.method == 'sum_pool':
+        elif method == 'sum_pool':
             x = x.size()[2] * x.size()[3] * F.adaptive_avg_pool2d(x, (1, 1))
             x = self.flatten(x)
-        elif self.method == 'sum_pool_2x2':
+        elif method == 'sum_pool_2x2':
             x = x.size()[2] * x.size()[3] * 0.25 * F.adaptive_avg_pool2d(x, (2, 2))
             x = self.flatten(x)
-        elif self.method == 'feature_map':
+        elif method == 'feature_map':
             pass
         else:
             x = self.gem(x)
             x = self.flatten(x)
         return x
 
+    def forward_once(self, x):
+        x = self.head(x)
+        return self.pool(x, self.method)
+
+    def forward_pooled(self, x, methods):
+        """one pass through self.head, pooled with every method of methods, keyed by method"""
+        x = self.head(x)
+        return {method: self.pool(x, method) for method in methods}
+
     def forward(self, input1, input2, input3):
         # score_positive_1 = 1 - (torch.sum(self.cos(out1, out2), axis=(1, 2)) / (out1.shape[2] * out1.shape[3]))
         # score_negative_1 = 1 - (torch.sum(self.cos(out1, out3), axis=(1, 2)) / (out1.shape[2] * out1.shape[3]))
@@ -7,32 +7,102 @@ import torchvision.transforms as transforms
 import torchvision.models as models
 
 from scipy import signal
+from scipy import fft as sp_fft
 from PIL import Image
 from sklearn.metrics.pairwise import cosine_similarity
 from scipy.spatial.distance import cosine
-from img2vec import Img2Vec
+from img2vec import get_img2vec
 
 from torch.autograd import Variable
 
 def image_cross_correlation(image1_array, image2_array):
     cross_correlation_list = []
     for i in range(np.shape(image2_array)[2]):
-        print (i)
         image1_channel = image1_array[:,:, i]
         image2_channel = image2_array[:, :, i]
-        channel_cross_correlation = signal.correlate2d(image1_channel, image2_channel)
+        # FFT-based, same values as signal.correlate2d(image1_channel, image2_channel)
+        channel_cross_correlation = signal.fftconvolve(image1_channel, image2_channel[::-1, ::-1])
         cross_correlation_list.append(channel_cross_correlation)
     avg_cross_correlation = np.average(cross_correlation_list)
 
     return avg_cross_correlation
 
+class CrossCorrelationEngine():
+    """
+    Batched normalized cross-correlation between one image and many candidates of the same size.
+    Every channel is made zero-mean and unit-norm, so the correlation at each shift lies in [-1, 1].
+    The score of a candidate is the peak over all shifts of the channel-averaged correlation.
+    Candidate spectra are computed once and cached: a comparison costs one FFT of the query
+    and one inverse FFT per candidate instead of a direct O(N^4) correlation.
+    """
+
+    def __init__(self, candidates, chunk_size=16):
+        """
+        candidates: array of shape (N, H, W, C) or (N, H, W)
+        chunk_size: number of candidates transformed at once, bounds the temporary memory
+        """
+        candidates = np.asarray(candidates)
+        if candidates.ndim == 3:
+            candidates = candidates[..., None]
+        self.shape = candidates.shape[1:3]
+        self.chunk_size = chunk_size
+        self.fft_shape = (sp_fft.next_fast_len(2 * self.shape[0] - 1, real=True),
+                          sp_fft.next_fast_len(2 * self.shape[1] - 1, real=True))
+        self.spectra = np.empty((len(candidates), candidates.shape[3], self.fft_shape[0],
+                                 self.fft_shape[1] // 2 + 1), dtype=np.complex64)
+        for i in range(0, len(candidates), chunk_size):
+            self.spectra[i:i + chunk_size] = self._spectrum(candidates[i:i + chunk_size])
+
+    def _spectrum(self, images):
+        images = np.moveaxis(np.asarray(images, dtype=np.float32), -1, 1)
+        images = images - images.mean(axis=(2, 3), keepdims=True)
+        norms = np.sqrt((images ** 2).sum(axis=(2, 3), keepdims=True))
+        images = np.divide(images, norms, out=np.zeros_like(images), where=norms > 0)
+        return sp_fft.rfft2(images, s=self.fft_shape, workers=-1)
+
+    def score(self, image, return_shifts=False):
+        """
+        image: array of shape (H, W, C) or (H, W), same size as the candidates
+        Returns the peak normalized cross-correlation with every candidate, shape (N, ),
+        and optionally the (dy, dx) shift of each candidate relative to image at the peak.
+        """
+        image = np.asarray(image)
+        if image.ndim == 2:
+            image = image[..., None]
+        if image.shape[:2] != self.shape:
+            raise ValueError("image of shape {} does not match candidates of shape {}".format(
+                image.shape[:2], self.shape))
+        query = np.conj(self._spectrum(image[None]))
+        scores = np.empty(len(self.spectra), dtype=np.float32)
+        shifts = np.empty((len(self.spectra), 2), dtype=int)
+        for i in range(0, len(self.spectra), self.chunk_size):
+            correlation = sp_fft.irfft2(query * self.spectra[i:i + self.chunk_size], s=self.fft_shape, workers=-1)
+            correlation = correlation.mean(axis=1).reshape(correlation.shape[0], -1)
+            peaks = correlation.argmax(axis=1)
+            scores[i:i + self.chunk_size] = correlation[np.arange(len(peaks)), peaks]
+            dy, dx = np.unravel_index(peaks, self.fft_shape)
+            # circular indices above the image size are negative shifts
+            shifts[i:i + self.chunk_size, 0] = np.where(dy < self.shape[0], dy, dy - self.fft_shape[0])
+            shifts[i:i + self.chunk_size, 1] = np.where(dx < self.shape[1], dx, dx - self.fft_shape[1])
+        if return_shifts:
+            return scores, shifts
+        return scores
+
+def normalized_cross_correlation(image, candidates):
+    """
+    Peak normalized cross-correlation between image and each candidate, see CrossCorrelationEngine.
+    Build the engine once instead when the same candidates are compared against several images.
+    """
+    return CrossCorrelationEngine(candidates).score(image)
+
 def find_distance(vector1, vector2):
     cos_dist = cosine(vector1, vector2)
     return cos_dist
 
-def get_model_distance(image1, image2, model_name):
+def get_model_distance(image1, image2, model_name, cuda=False):
 
-    img2vec = Img2Vec(model=model_name)
+    # loaded networks are shared across calls through the model registry
+    img2vec = get_img2vec(model=model_name, cuda=cuda)
     img1_vec = img2vec.get_vec(image1)
     img2_vec = img2vec.get_vec(image2)
 
@@ -40,6 +110,44 @@ def get_model_distance(image1, image2, model_name):
 
     return distance
 
+def load_image(image_path, size):
+    image = Image.open(image_path).convert('RGB')
+    image = image.resize((size, size), Image.LANCZOS)
+    return image
+
+def get_batch_model_vectors(images, model_name, batch_size=32, cuda=False):
+    """
+    Embed a stack of uint8 images (N, H, W, 3) with one backbone, batch_size images per forward pass.
+    """
+    img2vec = get_img2vec(model=model_name, cuda=cuda)
+    vectors = []
+    for i in range(0, len(images), batch_size):
+        batch = [Image.fromarray(image) for image in images[i:i + batch_size]]
+        vectors.append(img2vec.get_vec(batch))
+    return np.vstack(vectors)
+
+def find_pair_distances(vectors1, vectors2):
+    """
+    Row-wise cosine distance between two arrays of vectors, same values as find_distance.
+    """
+    vectors1 = np.asarray(vectors1, dtype=np.float64)
+    vectors2 = np.asarray(vectors2, dtype=np.float64)
+    dot = np.sum(vectors1 * vectors2, axis=1)
+    norms = np.linalg.norm(vectors1, axis=1) * np.linalg.norm(vectors2, axis=1)
+    return 1.0 - dot / norms
+
+def find_pair_pixel_distances(images, index1, index2, chunk_size=256):
+    """
+    Pixel-wise L2 distance between images[index1[i]] and images[index2[i]], images in [0, 255].
+    """
+    distances = np.empty(len(index1))
+    for i in range(0, len(index1), chunk_size):
+        image1_array = images[index1[i:i + chunk_size]] / 255.0
+        image2_array = images[index2[i:i + chunk_size]] / 255.0
+        diff = (image1_array - image2_array).reshape(len(image1_array), -1)
+        distances[i:i + chunk_size] = np.linalg.norm(diff, axis=1)
+    return distances
+
 
 
 